@@ -19,9 +19,9 @@ from tempfile import mkdtemp
 from shutil import rmtree
 from threading import BoundedSemaphore, RLock
 from subprocess import Popen, PIPE
-from mutagen import FileType
 from audiomangler.config import Config
-from audiomangler.tag import NormMetaData
+from audiomangler.tag import NormMetaData, evaluate_many
+from audiomangler.scanindex import deferred_write
 from audiomangler.task import CLITask, CLIPipelineTask, PoolTask, FuncTask, GroupTask, generator_task, reactor
 from multiprocessing import cpu_count
 from audiomangler.expression import Expr, Format
@@ -34,6 +34,7 @@ from twisted.internet.defer import DeferredList
 from twisted.python.failure import Failure
 from audiomangler.logging import *
 from functools import wraps, partial
+from itertools import groupby
 
 codec_map = {}
 idexpr = Format("$first(releasetype == 'soundtrack' and 'Soundtrack', albumartist, artist, '[Unknown]')::$first(album, '[Unknown]')[$first('%02d.' % discnumber if discnumber > 0 else '', '')$first('%02d' % tracknumber, '')]")
@@ -98,7 +99,7 @@ class Codec(object):
         stdin = 'w'
         if infile and hasattr(cls, 'from_wav_pipe_stdin'):
             stdin = cls.from_wav_pipe_stdin.evaluate(env)
-        return CLITask(*args, stdin=stdin, _id="%s.from_wav_pipe{%s}" % (cls.__name__, idexpr.evaluate(meta.flat())))
+        return CLITask(*args, stdin=stdin, _id="%s.from_wav_pipe{%s}" % (cls.__name__, meta.evaluate(idexpr)))
 
     @classmethod
     def to_wav_pipe(cls, infile, outfile, meta):
@@ -115,7 +116,7 @@ class Codec(object):
         stdout = 'r'
         if outfile and hasattr(cls, 'to_wav_pipe_stdout'):
             stdout = 'w:' + cls.to_wav_pipe_stdout.evaluate(env)
-        return CLITask(*args, stdout=stdout, _id="%s.to_wav_pipe{%s}" % (cls.__name__, idexpr.evaluate(meta.flat())))
+        return CLITask(*args, stdout=stdout, _id="%s.to_wav_pipe{%s}" % (cls.__name__, meta.evaluate(idexpr)))
 
     @classmethod
     @generator_task
@@ -455,6 +456,13 @@ def album_transcode_generator(sets, targettids, allowedcodecs, targetcodec):
         else:
             yield album_transcode_one(album, targetcodec)
 
+def _dir_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime)
+
 def copy_rename_files(files, fromdir=None, ignorefiles=None, sourcepaths=None, op='move'):
     track_op_func = getattr(util, op)
     op_func = util.copy if sourcepaths else getattr(util, op)
@@ -470,8 +478,11 @@ def copy_rename_files(files, fromdir=None, ignorefiles=None, sourcepaths=None, o
         sourcepaths = [file_obj.meta['path'] for file_obj in files]
     if ignorefiles is None:
         ignorefiles = frozenset([file_obj.meta['name'] for file_obj in files])
+    tids = evaluate_many(Expr(Config['trackid']), [file_obj.meta for file_obj in files])
+    written = []
     dstdirs = set()
-    for file_obj, src in zip(files, sourcepaths):
+    created = set()
+    for file_obj, src, tid in zip(files, sourcepaths, tids):
         dst = util.fsencode(file_obj.format())
         if 'type' in file_obj:
             dst = '%s.%s' % (dst, file_obj['type'])
@@ -489,13 +500,23 @@ def copy_rename_files(files, fromdir=None, ignorefiles=None, sourcepaths=None, o
             except OSError, e:
                 if e.errno != errno.EEXIST or not os.path.isdir(dstdir):
                     raise
+            else:
+                created.add(dstdir)
             dstdirs.add(dstdir)
         if op_track == 'transcode':
             src = file_obj.meta['path']
         msg(consoleformat=u"  %(src_p)s -> %(dst_p)s",
             format="%(op)s: %(src)r, %(dst)r",
             src=src, dst=dst, src_p=src_p, dst_p=dst_p, op=op_track, loglevel=INFO)
+        before = _dir_key(dstdir)
         track_op_func(src, dst)
+        written.append((dst, tid, before, _dir_key(dstdir)))
+    #keep the target trackid index current, so the next sync doesn't have to
+    #rescan the directories written to.
+    def add_trackids(index):
+        for dst, tid, before, after in written:
+            index.add_trackid(dst, tid, before, after, os.path.dirname(dst) in created)
+    deferred_write(add_trackids)
     if fromdir and len(dstdirs) == 1:
         dstdir = dstdirs.pop()
         for file in os.listdir(fromdir):
@@ -540,38 +561,54 @@ def sync_sets(sets=[], targettids=()):
         allowedcodecs = set((targetcodec,))
     targetcodec = get_codec(targetcodec)
     postadd = {'type':targetcodec.type_, 'ext':targetcodec.ext}
-    dstdirs = set()
-    onsplit = Config['onsplit']
-    newsets = []
-    while sets:
-        fileset = sets.pop()
-        srcs = set(file.meta['dir'] for file in fileset)
-        dsts = set(os.path.split(file.format(postadd=() if file.type_ in allowedcodecs else postadd))[0] for file in fileset)
-        dsts = tuple(dsts)
-        if onsplit == 'abort':
-            if len(dsts) > 1:
-                fatal(consoleformat=u"tracks in %(src)s would be placed in different target directories, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
-                    format="split: {src:%(src)r", src=srcs.pop(), nologerror=1)
-            if len(srcs) > 1:
-                fatal(consoleformat=u"tracks in from directories %(src)s would be placed in target directory %(dst)r, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
-                    format="split: %(src)r", src=tuple(srcs), dst=dsts[0], nologerror=1)
-            if dsts[0] in dstdirs:
-                fatal(consoleformat=u"tracks in %(src)s would be placed in %(dst)s, which is already the target for other tracks, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
-                    format="split: %(src)r", src=tuple(srcs), dst=dsts[0], nologerror=1)
-        dstdirs.add(dsts[0])
-        if any(file.meta.evaluate(tidexpr) not in targettids for file in fileset):
-            newsets.append(fileset)
-    sets = newsets
+    jobs = int(Config.get('jobs', cpu_count()))
+    def new_sets(sets):
+        #sets may be a generator of albums still being scanned, so check and
+        #pass on each album as it arrives, growing the thread pool when needed.
+        dstdirs = set()
+        onsplit = Config['onsplit']
+        pool_size = 0
+        for fileset in sets:
+            srcs = set(file.meta['dir'] for file in fileset)
+            dsts = set(os.path.split(file.format(postadd=() if file.type_ in allowedcodecs else postadd))[0] for file in fileset)
+            dsts = tuple(dsts)
+            if onsplit == 'abort':
+                if len(dsts) > 1:
+                    fatal(consoleformat=u"tracks in %(src)s would be placed in different target directories, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
+                        format="split: {src:%(src)r", src=srcs.pop(), nologerror=1)
+                if len(srcs) > 1:
+                    fatal(consoleformat=u"tracks in from directories %(src)s would be placed in target directory %(dst)r, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
+                        format="split: %(src)r", src=tuple(srcs), dst=dsts[0], nologerror=1)
+                if dsts[0] in dstdirs:
+                    fatal(consoleformat=u"tracks in %(src)s would be placed in %(dst)s, which is already the target for other tracks, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
+                        format="split: %(src)r", src=tuple(srcs), dst=dsts[0], nologerror=1)
+            dstdirs.add(dsts[0])
+            tids = evaluate_many(tidexpr, [file.meta for file in fileset])
+            if any(tid not in targettids for tid in tids):
+                if len(fileset) * (2 + jobs) > pool_size:
+                    pool_size = len(fileset) * (2 + jobs)
+                    reactor.suggestThreadPoolSize(pool_size)
+                yield fileset
     if targetcodec.has_from_wav_pipe:
         task_generator = track_transcode_generator
     elif targetcodec.has_from_wav_multi:
         task_generator = album_transcode_generator
-    reactor.suggestThreadPoolSize(max(len(alb) for alb in sets) * (2 + int(Config.get('jobs', cpu_count()))))
+    if isinstance(sets, list):
+        #check every album before starting on any of them
+        sets = list(new_sets(reversed(sets)))
+    else:
+        sets = new_sets(sets)
     PoolTask(task_generator(sets, targettids, allowedcodecs, targetcodec)).run()
     return
 
 dirmap_entry = namedtuple('dirmap_entry',('dirs','srcfiles'))
-def check_rename_sync(albums, dirs, mode='rename', targettids = ()):
+def check_rename_sync(albums, dirs, mode='rename', targettids = (), seen = None):
+    """Check albums for source directories that would be split and for target
+    paths that would conflict, exiting if any are found. To check albums in
+    parts, pass the same dict as seen each time: it holds the sources of the
+    target paths of the albums already checked."""
+    if seen is None:
+        seen = {}
     targettids = frozenset(targettids)
     if targettids:
         tidexpr = Expr(Config['trackid'])
@@ -597,7 +634,8 @@ def check_rename_sync(albums, dirs, mode='rename', targettids = ()):
         postadd = ()
         allowedcodecs = None
     for album in albums.values():
-        if all(track.meta.evaluate(tidexpr) in targettids for track in album):
+        if tidexpr is not None and all(tid in targettids for tid in
+                evaluate_many(tidexpr, [track.meta for track in album])):
             continue
         dsts = [util.fsencode(file.format(postadd=() if allowedcodecs and file.type_ in allowedcodecs else postadd)) for file in album]
         for src, dst in zip(album, dsts):
@@ -624,7 +662,9 @@ def check_rename_sync(albums, dirs, mode='rename', targettids = ()):
                 src_p = util.fsdecode(src)
                 dsp_p = util.fsdecode(dst)
                 dstpaths.setdefault(dst, []).append(src)
-    for dst,srcs in dstpaths.items():
+    for dst,new in dstpaths.items():
+        srcs = seen.setdefault(dst, [])
+        srcs.extend(new)
         if onconflict == 'error':
             if len(srcs) > 1:
                 srcs_p = u', '.join(util.fsdecode(s) for s in srcs)
@@ -648,8 +688,20 @@ def check_rename_sync(albums, dirs, mode='rename', targettids = ()):
     if wassplit or wasconflict:
         sys.exit(1)
 
+def check_sync_sets(sets, targettids=()):
+    """Yield the albums in sets, which is streamed from scan_albums, running
+    check_rename_sync on the albums of each directory before any of them are
+    passed on, so that none are written to paths that conflict with those of
+    the albums before them."""
+    seen = {}
+    for dir_, albums in groupby(sets, lambda album: album[0].meta['dir']):
+        albums = list(albums)
+        check_rename_sync(dict(enumerate(albums)), None, 'sync', targettids, seen)
+        for album in albums:
+            yield album
+
 def get_codec(item):
-    if isinstance(item, FileType):
+    if not isinstance(item, basestring):
         item = getattr(item, 'type_')
     return codec_map[item]
 
@@ -15,9 +15,10 @@ import errno
 from functools import wraps
 from audiomangler.config import Config
 from audiomangler import util
-from audiomangler.audiocodecs import sync_sets, get_codec, check_rename_sync
-from audiomangler.scanner import scan
+from audiomangler.audiocodecs import sync_sets, get_codec, check_rename_sync, check_sync_sets
+from audiomangler.scanner import scan, scan_albums, dir_local, target_trackids
 from audiomangler.task import PoolTask
+from audiomangler.watch import watch as watch_roots
 from audiomangler.logging import *
 
 def parse_options(options = ()):
@@ -152,9 +153,15 @@ def rename(*args):
    )
 )
 def sync(*args):
+    targettids = target_trackids()
+    if dir_local(Config['groupby']):
+        #albums can't span directories, so start transcoding each one as soon
+        #as it has been scanned, checking each directory's albums for splits
+        #and conflicts with those before them as they are queued.
+        sync_sets(check_sync_sets(scan_albums(args), targettids), targettids)
+        return
     (album_list, dir_list) = scan(args)[:2]
-    targettids = scan(Config['base'])[2]
-    check_rename_sync(album_list, dir_list, targettids)
+    check_rename_sync(album_list, dir_list, 'sync', targettids)
     sync_sets(album_list.values(), targettids)
 
 def replaygain_task_generator(album_list):
@@ -200,4 +207,13 @@ def replaygain(*args):
     (album_list) = scan(args)[0]
     PoolTask(replaygain_task_generator(album_list)).run()
 
+@parse_options(common_opts[1:2])
+def watch(*args):
+    if not args:
+        args = (Config['base'], )
+    try:
+        watch_roots(args)
+    except KeyboardInterrupt:
+        pass
+
 __all__ = []
\ No newline at end of file
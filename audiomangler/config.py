@@ -88,6 +88,10 @@ Config = AMConfig(
                 "('dir', dir)"
             ")"
          ),
+         ('groupby_local', 'no'),
+         ('trusted_expressions', 'no'),
+         ('expr_cache_size', '1024'),
+         ('format_cache_size', '256'),
          ('loglevel', 'VERBOSE'),
          ('consolelevel', 'INFO'),
          ('trackid',
@@ -105,6 +109,19 @@ Config = AMConfig(
             "$first('%02d ' % tracknumber, '')"
             "$title$first('.%s' % ext, '')"
          ),
+         ('scan_verify', 'files'),
+         ('scan_order', 'name'),
+         ('scan_batch', '256'),
+         ('scan_readahead', '0'),
+         ('scan_prefetch_threads', '0'),
+         ('scan_prefetch', '65536'),
+         ('index_timeout', '60'),
+         ('index_commit', '2s'),
+         ('collision_report', ''),
+         ('scan_extensions',
+            'flac,mp3,mp2,ogg,oga,opus,spx,wv,ape,mpc,mp4,m4a,m4b,tta,ofr,asf,wma,'
+            'aif,aiff,aifc,dsf,aac,ac3,tak'
+         ),
          ('fs_encoding', 'utf8'),
          ('fs_encoding_error', 'replace'),
       ),
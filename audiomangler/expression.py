@@ -9,6 +9,9 @@
 import os.path
 import re
 import codecs
+import ast as pyast
+from audiomangler.config import Config
+from audiomangler.util import LRUCache
 from RestrictedPython.RCompile import RExpression
 from RestrictedPython.MutatingWalker import walk
 from RestrictedPython.Guards import safe_builtins as eval_builtins
@@ -25,18 +28,35 @@ eval_builtins.update(filter=filter, map=map, max=max, min=min, reduce=reduce, re
 del eval_builtins['delattr']
 del eval_builtins['setattr']
 eval_globals = {'__builtins__':eval_builtins, '_getattr_':getattr, '_getitem_': lambda x, y: x[y]}
+_missing = object()
 
 def underscorereplace_errors(e):
     return (u'_' * (e.end - e.start), e.end)
 
 codecs.register_error('underscorereplace', underscorereplace_errors)
 
+def trusted_default():
+    "Return whether expressions are compiled in trusted mode unless told otherwise."
+    return (Config['trusted_expressions'] or '').lower() in ('1', 'yes', 'true', 'on')
+
 def evaluate(item, cdict):
     if isinstance(item, Expr):
         return item.evaluate(cdict)
     else:
         return item
 
+def _rows(columns, fields=None):
+    """Return a list of dicts from columns, a dict of equal length sequences,
+    with only the keys in fields, if given, leaving out None values."""
+    if not columns:
+        return []
+    length = len(columns.itervalues().next())
+    keys = [key for key in columns if fields is None or key in fields]
+    if not keys:
+        return [{} for i in xrange(length)]
+    return [dict([item for item in zip(keys, values) if item[1] is not None])
+        for values in zip(*[columns[key] for key in keys])]
+
 class InlineFuncsVisitor:
     def __init__(self, filename, baseexpr):
         self.filename = filename
@@ -62,7 +82,7 @@ class InlineFuncsVisitor:
             if not isinstance(item, ast.Const) or isinstance(item.value, basestring):
                 if isinstance(item, ast.Const):
                     item = item.value
-                item = self.baseexpr(item, self.filename)
+                item = self.baseexpr(item, self.filename, None, False)
                 item = ast.Const(item.evaluate)
                 item.lineno = node.lineno
                 item = ast.CallFunc(item, [clocals])
@@ -70,27 +90,294 @@ class InlineFuncsVisitor:
             exp.nodes.append(item)
         return exp
 
+def _base(cls):
+    "Return the class an expression of class cls uses for expressions inlined into it."
+    return getattr(cls, '_baseexpr', None) or cls
+
+def expr_fields(cls, source, baseexpr=None):
+    """Return the set of names read by source as an expression of class cls,
+    including those read by the expressions inlined into it."""
+    baseexpr = baseexpr or _base(cls)
+    result = set()
+    if isinstance(source, basestring) and issubclass(cls, Format):
+        for item in cls._split(source):
+            if not isinstance(item, basestring):
+                result.update(expr_fields(item[0], item[1], baseexpr))
+        return result
+    if isinstance(source, basestring):
+        source = pyast.parse('\n'.join(source.splitlines()), '<expression>', 'eval').body
+    nodes = list(pyast.walk(source))
+    bound = set(node.id for node in nodes
+        if isinstance(node, pyast.Name) and not isinstance(node.ctx, pyast.Load))
+    calls = set()
+    for node in nodes:
+        if (isinstance(node, pyast.Call) and isinstance(node.func, pyast.Name) and
+                node.func.id == 'first' and 'first' not in bound):
+            calls.add(node.func)
+            for arg in node.args:
+                if isinstance(arg, pyast.Str):
+                    result.update(expr_fields(baseexpr, arg.s))
+        elif (isinstance(node, pyast.Name) and isinstance(node.ctx, pyast.Load) and
+                node not in calls and node.id not in bound and
+                node.id not in TrustedCompiler._constants):
+            result.add(node.id)
+    return result
+
+class _Placeholders(pyast.NodeTransformer):
+    def __init__(self, nodes):
+        self.nodes = nodes
+    def visit_Name(self, node):
+        if node.id in self.nodes:
+            return self.visit(self.nodes.pop(node.id))
+        return node
+
+class TrustedCompiler(object):
+    """Compile an expression, and every expression inlined into it by first()
+    or a template, into one module of plain Python functions taking the
+    metadata dict. Fields are looked up in the dict, falling back to builtins,
+    and those used more than once in a function are looked up once, at its
+    start; first() arguments become chained
+    if statements, each with its own NameError handler, so that nothing is
+    evaluated through eval or the RestrictedPython guards. Only first() calls
+    under a conditional, a lambda or a comprehension become calls to a
+    separate function."""
+    _globals = {'__builtins__':eval_builtins, '_unicode':unicode,
+        '_pathseptrans':pathseptrans, '_pathtrans':pathtrans, '_missing':_missing}
+    _constants = ('None', 'True', 'False')
+
+    def __init__(self, filename=""):
+        self.filename = filename or '<expression>'
+        self.functions = []
+        self.lines = None
+        self.fields = None
+        self.helpers = []
+        self.nodes = {}
+        self.count = 0
+
+    def compile(self, cls, source, baseexpr=None, batch=False):
+        """Return a function evaluating source as an expression of class cls, or
+        if batch is set, a function evaluating it for a sequence of dicts."""
+        self.function('_expr', lambda var, indent:
+            self.scope(cls, source, baseexpr or _base(cls), var, indent), batch)
+        return self.build()
+
+    def compile_tuple(self, exprs, batch=False):
+        """Return a function evaluating exprs, a list of (class, source, baseexpr),
+        returning a tuple of their values, or with batch, as for compile."""
+        def body(var, indent):
+            values = []
+            for cls, source, baseexpr in exprs:
+                values.append(self.name('t'))
+                self.scope(cls, source, baseexpr or _base(cls), values[-1], indent)
+            self.emit(indent, '%s = (%s)' % (var, ''.join(value + ', ' for value in values)))
+        self.function('_expr', body, batch)
+        return self.build()
+
+    def build(self):
+        tree = pyast.parse('\n'.join(self.functions), self.filename, 'exec')
+        tree = pyast.fix_missing_locations(_Placeholders(self.nodes).visit(tree))
+        namespace = self._globals.copy()
+        exec compile(tree, self.filename, 'exec') in namespace
+        return namespace['_expr']
+
+    def name(self, prefix):
+        self.count += 1
+        return '_%s%d' % (prefix, self.count)
+
+    def placeholder(self, node):
+        name = self.name('x')
+        self.nodes[name] = node
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def function(self, name, body, batch=False):
+        """Emit a function, with body called to emit statements setting its value.
+        A batch function loops over a sequence of dicts, returning a list of
+        values, with the globals and builtins it uses bound to locals."""
+        outer = self.lines, self.fields
+        self.lines = []
+        self.fields = []
+        indent = 2 if batch else 1
+        body('_v', indent)
+        counts = {}
+        for placeholder, field, optional in self.fields:
+            counts[field] = counts.get(field, 0) + 1
+        shared = sorted(field for field in counts if counts[field] > 1)
+        head = ['    ' * indent + '_f_%s = _d.get(%r, _missing)' % (field, field)
+            for field in shared]
+        if batch:
+            hoisted = [key for key in sorted(self._globals) if key != '__builtins__']
+            hoisted.extend(self.helpers)
+            hoisted.extend(sorted(field for field in counts if field in eval_builtins))
+            head[:0] = ['def %s(_records, %s):' % (name, ', '.join('%s=%s' % (key, key)
+                for key in hoisted)), '    _result = []', '    _append = _result.append',
+                '    for _d in _records:']
+            self.emit(2, '_append(_v)')
+            self.emit(1, 'return _result')
+        else:
+            head[:0] = ['def %s(_d):' % name]
+            self.emit(1, 'return _v')
+        self.lines[:0] = head
+        for placeholder, field, optional in self.fields:
+            fallback = field if not optional or field in eval_builtins else 'None'
+            if field in shared:
+                source = '_f_%s if _f_%s is not _missing else %s' % (field, field, fallback)
+            elif not optional:
+                source = '_d[%r] if %r in _d else %s' % (field, field, field)
+            else:
+                source = '_d.get(%r, %s)' % (field, fallback)
+            self.nodes[placeholder] = pyast.parse(source, mode='eval').body
+        self.functions.append('\n'.join(self.lines))
+        self.lines, self.fields = outer
+        return name
+
+    def field(self, name, optional=False):
+        """Return a placeholder for looking up field name, raising NameError if it
+        is missing and not a builtin, or if optional is set, giving None instead."""
+        placeholder = self.name('x')
+        self.fields.append((placeholder, name, optional))
+        return placeholder
+
+    def scope(self, cls, source, baseexpr, var, indent):
+        "Emit statements setting var to the value of source as an expression of class cls."
+        if isinstance(source, basestring) and issubclass(cls, Format):
+            self.template(cls, source, baseexpr, var, indent)
+        else:
+            self.expression(source, baseexpr, var, indent)
+        if cls._trusted_post:
+            self.emit(indent, cls._trusted_post % {'v': var})
+
+    def template(self, cls, source, baseexpr, var, indent):
+        parts = []
+        values = []
+        for item in cls._split(source):
+            if isinstance(item, basestring):
+                parts.append(self.placeholder(pyast.Str(item)))
+            else:
+                value = self.name('t')
+                self.scope(item[0], item[1], baseexpr, value, indent)
+                parts.append(value)
+                values.append(value)
+        joined = "%s = ''.join((%s))" % (var, ''.join(part + ', ' for part in parts))
+        if values:
+            self.emit(indent, 'if %s:' % ' or '.join(value + ' is None' for value in values))
+            self.emit(indent + 1, '%s = None' % var)
+            self.emit(indent, 'else:')
+            self.emit(indent + 1, joined)
+        elif len(parts) < 2:
+            self.emit(indent, '%s = %s' % (var, ''.join(parts) or "''"))
+        else:
+            self.emit(indent, joined)
+
+    def expression(self, source, baseexpr, var, indent):
+        if isinstance(source, basestring):
+            source = pyast.parse('\n'.join(source.splitlines()), self.filename, 'eval').body
+        if isinstance(source, pyast.Name) and source.id not in self._constants:
+            self.emit(indent, '%s = %s' % (var, self.field(source.id, True)))
+        elif isinstance(source, (pyast.Name, pyast.Num, pyast.Str)):
+            self.emit(indent, '%s = %s' % (var, self.placeholder(source)))
+        else:
+            bound = set(node.id for node in pyast.walk(source)
+                if isinstance(node, pyast.Name) and not isinstance(node.ctx, pyast.Load))
+            source = self.rewrite(source, bound, baseexpr, indent, True)
+            self.emit(indent, 'try:')
+            self.emit(indent + 1, '%s = %s' % (var, self.placeholder(source)))
+            self.emit(indent, 'except NameError:')
+            self.emit(indent + 1, '%s = None' % var)
+
+    def first(self, args, baseexpr, var, indent):
+        if not args:
+            self.emit(indent, '%s = None' % var)
+        for i, arg in enumerate(args):
+            if i:
+                self.emit(indent, 'if not %s:' % var)
+                indent += 1
+            if isinstance(arg, pyast.Num):
+                self.emit(indent, '%s = %s' % (var, self.placeholder(arg)))
+            else:
+                self.scope(baseexpr, arg.s if isinstance(arg, pyast.Str) else arg,
+                    _base(baseexpr), var, indent)
+
+    def rewrite(self, node, bound, baseexpr, indent, safe):
+        """Rewrite names in node to be looked up in the metadata dict, and first()
+        calls to the value of statements emitted before it, where safe says
+        that node is always evaluated when the expression around it is."""
+        if isinstance(node, pyast.Name):
+            if (isinstance(node.ctx, pyast.Load) and node.id not in bound and
+                    node.id not in self._constants):
+                return pyast.Name(self.field(node.id), pyast.Load())
+            return node
+        if (isinstance(node, pyast.Call) and isinstance(node.func, pyast.Name) and
+                node.func.id == 'first' and 'first' not in bound):
+            if safe:
+                var = self.name('t')
+                self.first(node.args, baseexpr, var, indent)
+                return pyast.Name(var, pyast.Load())
+            name = self.function(self.name('f'),
+                lambda var, indent: self.first(node.args, baseexpr, var, indent))
+            self.helpers.append(name)
+            return pyast.Call(pyast.Name(name, pyast.Load()),
+                [pyast.Name('_d', pyast.Load())], [], None, None)
+        for field, value in pyast.iter_fields(node):
+            if isinstance(value, list):
+                value[:] = [self.rewrite(item, bound, baseexpr, indent,
+                        self.safe(node, field, i) and safe)
+                    if isinstance(item, pyast.AST) else item
+                    for i, item in enumerate(value)]
+            elif isinstance(value, pyast.AST):
+                setattr(node, field, self.rewrite(value, bound, baseexpr, indent,
+                    self.safe(node, field, 0) and safe))
+        return node
+
+    def safe(self, node, field, index):
+        if isinstance(node, (pyast.Lambda, pyast.GeneratorExp, pyast.ListComp,
+                pyast.SetComp, pyast.DictComp)):
+            return False
+        if isinstance(node, pyast.IfExp):
+            return field == 'test'
+        if isinstance(node, pyast.BoolOp):
+            return index == 0
+        return True
+
 class Expr(RExpression, object):
     _globals = eval_globals
-    _cache = {}
+    #compiled expressions by source, shared by all the subclasses
+    _cache = LRUCache(lambda: Config['expr_cache_size'])
+    _trusted_post = None
+    _many = None
 
-    def __new__(cls, source, filename="", baseexpr=None):
-        key = (cls, source, filename, baseexpr)
+    def __new__(cls, source, filename="", baseexpr=None, trusted=None):
+        if trusted is None:
+            trusted = trusted_default()
+        key = (cls, source, filename, baseexpr, trusted)
         if isinstance(source, basestring):
-            if key not in cls._cache:
-                cls._cache[key] = object.__new__(cls)
-            return cls._cache[key]
+            expr = cls._cache.get(key)
+            if expr is None:
+                expr = cls._cache[key] = object.__new__(cls)
+            return expr
         elif isinstance(source, ast.Node):
             return object.__new__(cls)
         elif isinstance(source, cls):
             return source
 
-    def __init__(self, source, filename="", baseexpr=None):
+    def __init__(self, source, filename="", baseexpr=None, trusted=None):
         if hasattr(self, '_compiled'):
             return
         self._source = source
-        self._baseexpr = baseexpr or getattr(self.__class__, '_baseexpr', None) or self.__class__
+        self._baseexpr = baseexpr or _base(self.__class__)
         self._filename = filename
+        if trusted is None:
+            trusted = trusted_default()
+        self._trusted = bool(trusted) and isinstance(source, basestring)
+        if self._trusted:
+            #evaluate is the compiled function itself, which handles NameError
+            #and the class's conversion of the result
+            self.evaluate = TrustedCompiler(filename).compile(self.__class__,
+                source, self._baseexpr)
+            self._compiled = self.evaluate.func_code
+            return
         if not isinstance(source, ast.Node):
             RExpression.__init__(self, source, filename)
             source = self._get_tree()
@@ -105,6 +392,20 @@ class Expr(RExpression, object):
     def __hash__(self):
         return hash(self._compiled)
 
+    @property
+    def fields(self):
+        """The names this expression reads from the dict it is evaluated with, as
+        a frozenset, or None if they aren't known."""
+        if not hasattr(self, '_fields'):
+            self._fields = None
+            if isinstance(self._source, basestring):
+                try:
+                    self._fields = frozenset(expr_fields(type(self), self._source,
+                        self._baseexpr))
+                except SyntaxError:
+                    pass
+        return self._fields
+
     def _get_tree(self):
         tree = RExpression._get_tree(self)
         walk(tree, InlineFuncsVisitor(self.filename, self._baseexpr))
@@ -116,7 +417,30 @@ class Expr(RExpression, object):
         except NameError:
             return None
 
+    def evaluate_many(self, records):
+        """Return a list of the values of this expression for each of records, a
+        sequence of dicts as for evaluate, or a dict of columns, each a sequence
+        with None for a missing value."""
+        if isinstance(records, dict):
+            records = _rows(records, self.fields)
+        if self._many is None:
+            self._many = self._compile_many()
+        return self._many(records)
+
+    def _compile_many(self):
+        "Return a function evaluating this expression for a sequence of dicts."
+        if self._trusted:
+            return TrustedCompiler(self._filename).compile(type(self), self._source,
+                self._baseexpr, True)
+        #restricted code passes locals() from each expression to the ones
+        #nested in it, and the guards are looked up by the compiled code, so
+        #nothing can be taken out of the loop.
+        evaluate = self.evaluate
+        return lambda records: [evaluate(cdict) for cdict in records]
+
 class StringExpr(Expr):
+    _trusted_post = "if %(v)s is not None: %(v)s = _unicode(%(v)s)"
+
     def evaluate(self, cdict):
         ret = super(self.__class__, self).evaluate(cdict)
         if ret is not None:
@@ -124,6 +448,8 @@ class StringExpr(Expr):
         return ret
 
 class SanitizedExpr(Expr):
+    _trusted_post = "if %(v)s is not None: %(v)s = _unicode(%(v)s).translate(_pathseptrans)"
+
     def evaluate(self, cdict):
         ret = super(self.__class__, self).evaluate(cdict)
         if ret is not None:
@@ -171,19 +497,26 @@ class Format(Expr):
         return result
 
     def _parse(self):
-        state = []
+        return [item if isinstance(item, basestring) else
+            item[0](item[1], self._filename, self._baseexpr, False)
+            for item in self._split(self._source)]
+
+    @classmethod
+    def _split(cls, source):
+        """Split template source into its literal strings and the
+        (expression class, source) of each substituted expression."""
         result = []
         cur = []
         prevend = 0
         while 1:
-            m = _subexpr.search(self._source, prevend)
+            m = _subexpr.search(source, prevend)
             if not m:
-                cur.append(self._source[prevend:])
+                cur.append(source[prevend:])
                 break
             mt = m.group(0)
             mg = m.groupdict()
             if m.start() > prevend:
-                cur.append(self._source[prevend:m.start()])
+                cur.append(source[prevend:m.start()])
             prevend = m.end()
             if mt == '$$':
                 cur.append('$')
@@ -191,11 +524,11 @@ class Format(Expr):
                 if any(cur):
                     result.append(''.join(cur))
                 cur = []
-                expr_class = StringExpr if mg['nosan'] or not self._sanitize else SanitizedExpr
+                expr_class = StringExpr if mg['nosan'] or not cls._sanitize else SanitizedExpr
                 if not mg['paren']:
-                    result.append(expr_class(mg['label'], self._filename, self._baseexpr))
+                    result.append((expr_class, mg['label']))
                 else:
-                    expr_text = self._source[prevend:]
+                    expr_text = source[prevend:]
                     try:
                         parse(expr_text, 'eval')
                     except SyntaxError, e:
@@ -203,27 +536,148 @@ class Format(Expr):
                         expr_text = expr_text[:e.offset-1]
                         if mg['label']:
                             expr_text = "%s(%s)" % (mg['label'], expr_text)
-                        result.append(expr_class(expr_text, self._filename, self._baseexpr))
+                        result.append((expr_class, expr_text))
                     else:
                         start = m.start()
-                        raise SyntaxError('Unexpected EOF while parsing', (None, 1, len(self._source) - start, self._source[start:]))
+                        raise SyntaxError('Unexpected EOF while parsing', (None, 1, len(source) - start, source[start:]))
         if any(cur):
             result.append(''.join(cur))
         return result
 
+    @classmethod
+    def _join(cls, items):
+        "Return template source for items, as returned by _split."
+        source = []
+        for item in items:
+            if isinstance(item, basestring):
+                source.append(item.replace('$', '$$'))
+            else:
+                nosan = item[0] is StringExpr and cls._sanitize
+                source.append('$%s(%s)' % ('/' if nosan else '', item[1]))
+        return ''.join(source)
+
 class SanitizedFormat(Format):
     _sanitize = True
 
 class FileFormat(SanitizedFormat):
+    """Template for a file's path. The directory part of the template, up to
+    its last literal '/', is evaluated once for each set of values of the
+    fields it reads, usually once per album, and kept in an LRU cache."""
     _baseexpr = SanitizedFormat
+    _trusted_post = "if %(v)s is not None: %(v)s = %(v)s.translate(_pathtrans)"
+
+    def __init__(self, source, filename="", baseexpr=None, trusted=None):
+        if hasattr(self, '_compiled'):
+            return
+        super(FileFormat, self).__init__(source, filename, baseexpr, trusted)
+        if not isinstance(source, basestring):
+            return
+        items = self._split(source)
+        for i in reversed(xrange(len(items))):
+            if isinstance(items[i], basestring) and '/' in items[i]:
+                break
+        else:
+            return
+        if all(isinstance(item, basestring) for item in items[:i]):
+            return
+        head, tail = items[i].rsplit('/', 1)
+        self._dir = SanitizedFormat(self._join(items[:i] + [head + '/']), filename,
+            self._baseexpr, trusted)
+        self._name = SanitizedFormat(self._join([tail] + items[i+1:]), filename,
+            self._baseexpr, trusted)
+        if self._dir.fields is None:
+            return
+        self._dir_fields = sorted(self._dir.fields)
+        self._dirs = LRUCache(lambda: Config['format_cache_size'])
+        self.evaluate = self._evaluate_split
+
+    def _dirname(self, cdict):
+        key = tuple([cdict.get(field, _missing) for field in self._dir_fields])
+        try:
+            dirname = self._dirs.get(key, _missing)
+        except TypeError:
+            #unhashable values
+            key = dirname = _missing
+        if dirname is _missing:
+            dirname = self._dir.evaluate(cdict)
+            if key is not _missing:
+                self._dirs[key] = dirname
+        return dirname
+
+    def _evaluate_split(self, cdict):
+        dirname = self._dirname(cdict)
+        name = self._name.evaluate(cdict)
+        if dirname is None or name is None:
+            return None
+        return (dirname + name).translate(pathtrans)
+
+    def _compile_many(self):
+        if not (self._trusted and hasattr(self, '_dirs')):
+            return super(FileFormat, self)._compile_many()
+        def many(records):
+            records = list(records)
+            result = []
+            append = result.append
+            dirname = self._dirname
+            for cdict, name in zip(records, self._name.evaluate_many(records)):
+                path = dirname(cdict)
+                if path is None or name is None:
+                    append(None)
+                else:
+                    append((path + name).translate(pathtrans))
+            return result
+        return many
+
     def evaluate(self, cdict):
         ret = super(self.__class__, self).evaluate(cdict)
         if ret is not None:
             ret = ret.translate(pathtrans)
         return ret
 
+class ExprTuple(Expr):
+    """Several expressions evaluated together, giving a tuple of their values,
+    so that a caller flattens metadata and makes one call for all of them.
+    When all of them are trusted they are compiled into one function, which
+    looks up the fields they share once."""
+    def __new__(cls, exprs, filename="", baseexpr=None, trusted=None):
+        exprs = tuple(Expr(expr, filename, None, trusted) for expr in exprs)
+        key = (cls, exprs)
+        expr = cls._cache.get(key)
+        if expr is None:
+            expr = cls._cache[key] = object.__new__(cls)
+        return expr
+
+    def __init__(self, exprs, filename="", baseexpr=None, trusted=None):
+        if hasattr(self, '_compiled'):
+            return
+        self._exprs = tuple(Expr(expr, filename, None, trusted) for expr in exprs)
+        self._source = tuple(expr._source for expr in self._exprs)
+        self._filename = filename
+        self._trusted = all(expr._trusted for expr in self._exprs)
+        if self._trusted:
+            self.evaluate = TrustedCompiler(filename).compile_tuple(self._members())
+        self._compiled = tuple(expr._compiled for expr in self._exprs)
+
+    def _members(self):
+        return [(type(expr), expr._source, expr._baseexpr) for expr in self._exprs]
+
+    @property
+    def fields(self):
+        fields = [expr.fields for expr in self._exprs]
+        if None in fields:
+            return None
+        return frozenset().union(*fields)
+
+    def evaluate(self, cdict):
+        return tuple([expr.evaluate(cdict) for expr in self._exprs])
+
+    def _compile_many(self):
+        if self._trusted:
+            return TrustedCompiler(self._filename).compile_tuple(self._members(), True)
+        return super(ExprTuple, self)._compile_many()
+
 #class Format(Expr):
 
 def unique(testset, expr, evalexpr): pass
 
-__all__ = ['Format', 'FileFormat', 'Expr', 'evaluate']
+__all__ = ['Format', 'FileFormat', 'Expr', 'ExprTuple', 'TrustedCompiler', 'evaluate', 'expr_fields']
@@ -22,7 +22,7 @@ class FilteredFileLogObserver(log.FileLogObserver):
         if '_noignore' not in eventDict and not eventDict['isError']: return
         if eventDict.get('loglevel', DEBUG) > self.loglevel:
             return
-        encoding = sys.stdout.encoding
+        encoding = sys.stdout.encoding or 'utf-8'
         if eventDict['isError'] and 'failure' in eventDict:
             text = log.textFromEventDict(eventDict)
         elif eventDict['message']:
@@ -57,7 +57,7 @@ class FilteredConsoleLogObserver(log.FileLogObserver):
 
         if eventDict.get('loglevel', DEBUG) > self.loglevel:
             return
-        encoding = sys.stdout.encoding
+        encoding = sys.stdout.encoding or 'utf-8'
         if eventDict['isError'] and 'failure' in eventDict:
             text = log.textFromEventDict(eventDict)
         elif eventDict['message']:
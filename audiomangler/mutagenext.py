@@ -7,7 +7,11 @@
 #
 ###########################################################################
 import os.path
-from mutagen import FileType
+import sys
+import types
+from hashlib import sha1
+from mutagen import File, FileType
+from mutagen import version as mutagen_version
 from mutagen.asf import ASF
 from mutagen.flac import FLAC, SeekPoint, CueSheetTrackIndex
 from mutagen.monkeysaudio import MonkeysAudio
@@ -23,6 +27,20 @@ from audiomangler.config import Config, from_config
 from audiomangler.tag import NormMetaData
 from audiomangler.expression import FileFormat
 
+#the modules of the types File() tries, which mutagen only imports on first
+#use. they are all imported here so that get_file_type finds every type and
+#parser_version doesn't depend on what a process happened to open first.
+_file_modules = ('aac', 'ac3', 'aiff', 'apev2', 'asf', 'dsf', 'easyid3',
+    'easymp4', 'flac', 'id3', 'monkeysaudio', 'mp3', 'mp4', 'musepack',
+    'oggflac', 'oggopus', 'oggspeex', 'oggtheora', 'oggvorbis', 'optimfrog',
+    'smf', 'tak', 'trueaudio', 'wavpack')
+for _name in _file_modules:
+    try:
+        __import__('mutagen.' + _name)
+    except ImportError:
+        #not in this version of mutagen
+        pass
+
 def _get_meta(self):
     metacache = getattr(self, '_meta_cache', (False, False))
     if metacache[0] is not getattr(self, 'filename', None) or metacache[1] \
@@ -58,16 +76,206 @@ def _set_meta(self, value):
 
 def _format(self, filename=None, base=None, preadd=(), postadd=()):
     filename, base = from_config('filename', 'base')
+    filename = FileFormat(filename)
     meta = NormMetaData(preadd)
-    meta.update(self.meta.flat())
+    meta.update(self.meta.flat(None, filename.fields))
     meta.update(postadd)
-    filename = FileFormat(filename)
     base = os.path.abspath(base)
     return os.path.join(base, filename.evaluate(meta))
 
 def has_replaygain(self):
     return reduce(lambda x, y: x and y in self.meta, ('replaygain_album_gain', 'replaygain_album_peak', 'replaygain_track_gain', 'replaygain_track_peak'), True)
 
+def _subclasses(cls):
+    for sub in cls.__subclasses__():
+        yield sub
+        for subsub in _subclasses(sub):
+            yield subsub
+
+file_types = {}
+def get_file_type(name):
+    "Return the mutagen FileType subclass with the given name, or None."
+    if name not in file_types:
+        file_types.update((c.__name__, c) for c in _subclasses(FileType))
+    return file_types.get(name)
+
+#versions of the fields of a TrackRecord stored in the scan index; bump one
+#when the way it is derived from a parsed file changes.
+record_versions = {'info': 1, 'tags': 1}
+
+def _mutagen_modules(module, found):
+    if module.__name__ in found:
+        return found
+    found.add(module.__name__)
+    #modules are followed through the classes and functions they import, not
+    #through module objects, as mutagen holds every submodule loaded so far.
+    #subpackages such as mutagen.id3 take all of their own submodules along,
+    #since what they export claims to come from the package itself.
+    names = [getattr(value, '__module__', None) for value in vars(module).values()
+        if not isinstance(value, types.ModuleType)]
+    if hasattr(module, '__path__') and module.__name__ != 'mutagen':
+        names.extend(name for name in sys.modules
+            if name.startswith(module.__name__ + '.') and sys.modules[name] is not None)
+    for name in names:
+        if isinstance(name, basestring) and name.split('.')[0] == 'mutagen' \
+                and sys.modules.get(name) is not None:
+            _mutagen_modules(sys.modules[name], found)
+    return found
+
+_parser_versions = {}
+def parser_version(kind):
+    """Return a digest identifying how files of the mutagen FileType named kind
+    are turned into TrackRecords: the source of every mutagen module that the
+    type's module uses, and record_versions. It only changes when a mutagen
+    upgrade touches code that can affect files of that type."""
+    if kind not in _parser_versions:
+        digest = sha1(repr(sorted(record_versions.items())))
+        cls = get_file_type(kind)
+        if cls is not None:
+            for name in sorted(_mutagen_modules(sys.modules[cls.__module__], set())):
+                path = getattr(sys.modules[name], '__file__', '')
+                if path.endswith(('.pyc', '.pyo')):
+                    path = path[:-1]
+                digest.update(name)
+                try:
+                    f = open(path, 'rb')
+                    try:
+                        digest.update(f.read())
+                    finally:
+                        f.close()
+                except IOError:
+                    digest.update(repr(mutagen_version))
+        _parser_versions[kind] = digest.hexdigest()
+    return _parser_versions[kind]
+
+#(offset, signature) of the formats mutagen can read. old Musepack streams
+#have none, and are found by their extension.
+magic = (
+    (0, 'fLaC'),
+    (0, 'ID3'),
+    (0, 'OggS'),
+    (0, 'wvpk'),
+    (0, 'MAC '),
+    (0, 'MP+'),
+    (0, 'MPCK'),
+    (0, 'TTA1'),
+    (0, 'OFR '),
+    (0, 'APETAGEX'),
+    (0, '0&\xb2u\x8ef\xcf\x11'),
+    (4, 'ftyp'),
+    (0, 'FORM'),
+    (0, 'DSD '),
+    (0, 'ADIF'),
+    (0, '\x0b\x77'),
+    (0, 'tBaK'),
+    (0, 'MThd'),
+)
+magic_size = max(offset + len(sig) for offset, sig in magic)
+
+def audio_extensions():
+    return frozenset(ext.strip().lower() for ext in
+        (Config['scan_extensions'] or '').split(',') if ext.strip())
+
+def sniff(path, extensions=None):
+    """Return True if path may be an audio file, either because its extension
+    is in extensions (Config['scan_extensions'] by default), or because its
+    first bytes match a known signature."""
+    if extensions is None:
+        extensions = audio_extensions()
+    if os.path.splitext(path)[1][1:].lower() in extensions:
+        return True
+    try:
+        f = open(path, 'rb')
+        try:
+            head = f.read(magic_size)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return False
+    for offset, sig in magic:
+        if head[offset:offset + len(sig)] == sig:
+            return True
+    #bare MPEG audio or ADTS AAC frame sync
+    return len(head) > 1 and head[0] == '\xff' and ord(head[1]) & 0xe0 == 0xe0
+
+#bump when what sniff takes for audio changes other than through magic
+sniff_rules = 1
+
+def sniff_version():
+    """Return a digest of what is taken for audio: the rules of sniff, with
+    the configured extensions, and the types and version of mutagen. Files
+    found not to be audio are looked at again when it changes."""
+    kinds = sorted(c.__name__ for c in _subclasses(FileType))
+    return sha1(repr((sniff_rules, sorted(audio_extensions()), magic, kinds,
+        mutagen_version))).hexdigest()
+
+class StreamInfo(object):
+    __slots__ = 'length', 'bitrate', 'sample_rate', 'channels'
+    def __init__(self, length=None, bitrate=None, sample_rate=None, channels=None):
+        self.length = length
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    @classmethod
+    def from_info(cls, info):
+        return cls(*(getattr(info, attr, None) for attr in cls.__slots__))
+
+def _file_type_attr(name, default=None):
+    return property(lambda self: getattr(get_file_type(self.kind), name, default))
+
+def _set_record_meta(self, value):
+    fileobj = self.load()
+    _set_meta(fileobj, value)
+    self.tags = NormMetaData.converted(fileobj)
+
+class TrackRecord(object):
+    """Compact record of a scanned track: its path, the name of its mutagen
+    FileType, stream info, cache key and normalized tags. The mutagen object
+    itself is only loaded, by load(), when the file's tags are to be written.
+    Values of expressions stored in the scan index for the track are kept in
+    derived, by expression digest, along with the stamp of the file and
+    relpath and the digest of the fields they were found for."""
+    __slots__ = ('filename', 'kind', 'info', 'tags', 'key', 'relpath', 'reldir',
+        'sortkey', 'tid', 'derived', '_meta_cache', '_meta', '_file')
+    format = _format
+    meta = property(_get_meta, _set_record_meta)
+    has_replaygain = has_replaygain
+    ext = _file_type_attr('ext')
+    type_ = _file_type_attr('type_')
+    lossless = _file_type_attr('lossless', False)
+
+    def __init__(self, filename, kind, info, tags, key=None):
+        self.filename = filename
+        self.kind = kind
+        self.info = info
+        self.tags = tags
+        self.key = key
+        self.derived = None
+        self._file = None
+
+    @classmethod
+    def from_file(cls, fileobj, key=None):
+        if getattr(fileobj, 'tags', None) is None:
+            tags = NormMetaData()
+        else:
+            try:
+                tags = NormMetaData.converted(fileobj)
+            except TypeError:
+                tags = NormMetaData()
+        return cls(fileobj.filename, type(fileobj).__name__,
+            StreamInfo.from_info(getattr(fileobj, 'info', None)), tags, key)
+
+    def load(self):
+        "Return the mutagen object for this track, reading it on first use."
+        if self._file is None:
+            self._file = File(self.filename)
+        return self._file
+
+    def save(self):
+        if self._file is not None:
+            self._file.save()
+
 def _newargs_untuplize(self):
     return super(self.__class__, self).__getnewargs__()[0]
 
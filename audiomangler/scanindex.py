@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+import os
+import os.path
+import errno
+import time
+import sqlite3
+import json
+import cPickle
+from hashlib import sha1
+from threading import Lock
+from audiomangler.config import Config
+from audiomangler.tag import NormMetaData
+from audiomangler.mutagenext import TrackRecord, StreamInfo, parser_version, sniff_version
+
+db_version = (1, 5)
+
+_schema = (
+    "CREATE TABLE IF NOT EXISTS version (value TEXT)",
+    "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, "
+        "ino INTEGER, mtime REAL, tree TEXT)",
+    "CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)",
+    "CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, "
+        "path TEXT UNIQUE, dir TEXT, ino INTEGER, size INTEGER, mtime REAL, "
+        "kind TEXT, length REAL, bitrate INTEGER, sample_rate INTEGER, "
+        "channels INTEGER)",
+    "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)",
+    "CREATE TABLE IF NOT EXISTS tags (file INTEGER, key TEXT, value TEXT)",
+    "CREATE INDEX IF NOT EXISTS tags_file ON tags (file)",
+    "CREATE TABLE IF NOT EXISTS parsers (kind TEXT PRIMARY KEY, version TEXT)",
+    "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS tid_dirs (path TEXT PRIMARY KEY, parent TEXT, "
+        "ino INTEGER, mtime REAL)",
+    "CREATE INDEX IF NOT EXISTS tid_dirs_parent ON tid_dirs (parent)",
+    "CREATE TABLE IF NOT EXISTS tids (path TEXT PRIMARY KEY, dir TEXT, tid TEXT)",
+    "CREATE INDEX IF NOT EXISTS tids_dir ON tids (dir)",
+    "CREATE TABLE IF NOT EXISTS derived (filename TEXT, expr TEXT, stamp TEXT, "
+        "inputs TEXT, value BLOB, PRIMARY KEY (filename, expr))",
+    "CREATE TABLE IF NOT EXISTS watches (root TEXT PRIMARY KEY, pid INTEGER, state TEXT)",
+    "CREATE TABLE IF NOT EXISTS dirty (path TEXT PRIMARY KEY, time REAL)",
+)
+
+#pictures is no longer used, and is only listed to be dropped
+_tables = ('version', 'dirs', 'files', 'tags', 'pictures', 'derived', 'parsers',
+    'settings', 'tid_dirs', 'tids', 'watches', 'dirty')
+
+def default_path():
+    homedir = os.getenv('HOME')
+    if homedir is not None:
+        indexfile = os.path.join(homedir, '.audiomangler')
+        try:
+            os.mkdir(indexfile)
+        except OSError:
+            pass
+        return os.path.join(indexfile, 'index.db')
+    else:
+        return 'audiomangler.db'
+
+def subtree(column, root):
+    """Return an SQL condition matching root and every path below it in column,
+    with its arguments. Paths below root sort between root + '/' and root + '0',
+    so the condition is a range on column's index rather than a scan."""
+    prefix = root.rstrip('/') + '/'
+    return ("(%s = ? OR (%s > ? AND %s < ?))" % (column, column, column),
+        (root, prefix, prefix[:-1] + '0'))
+
+def tree_hashes(parents, files, dir_key, file_key):
+    """Compute the subtree hash of each directory in parents, a dict of
+    path: parent, bottom-up. files maps directories to lists of (path, key),
+    and dir_key(path) and file_key(path, key) give the keys to hash, or None
+    for an entry that is missing. A directory's hash covers its own key, the
+    keys of its files and the hashes of its subdirectories, and is None if
+    any of them is missing."""
+    children = {}
+    for path, parent in parents.iteritems():
+        children.setdefault(parent, []).append(path)
+    hashes = {}
+    for path in sorted(parents, key=len, reverse=True):
+        key = dir_key(path)
+        if key is None or None in key:
+            hashes[path] = None
+            continue
+        h = sha1('%d %r\n' % key)
+        for filename, fkey in sorted(files.get(path, ())):
+            fkey = file_key(filename, fkey)
+            if fkey is None or None in fkey:
+                h = None
+                break
+            h.update('%s %d %d %r\n' % ((filename, ) + tuple(fkey)))
+        for child in sorted(children.get(path, ())):
+            if h is None or hashes[child] is None:
+                h = None
+                break
+            h.update('%s %s\n' % (child, hashes[child]))
+        hashes[path] = h and h.hexdigest()
+    return hashes
+
+def expr_digest(expr):
+    """Return a digest identifying expr, for storing its values in the index.
+    Trusted and restricted compilation can give different values for the same
+    source, so the mode is part of the digest."""
+    return sha1(repr((type(expr).__name__, expr._source, expr._trusted,
+        Config['fs_encoding'], Config['fs_encoding_error']))).hexdigest()
+
+def inputs_digest(expr, meta):
+    """Return a digest of the values in meta, a flattened dict, of the fields
+    expr reads, or None if they aren't known."""
+    fields = expr.fields
+    if fields is None:
+        return None
+    return sha1(repr([(field, meta.get(field)) for field in sorted(fields)])).hexdigest()
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+#indexes that scans in this process are writing, which take the writes of
+#other threads in this process, such as the sync code's, rather than have
+#them wait on their open transactions.
+_shared = []
+_shared_lock = Lock()
+
+def deferred_write(func):
+    """Call func with a ScanIndex to write to. If a scan in this process is
+    writing the index, func is queued for it to run before its next commit,
+    and this returns at once; otherwise func runs now, on a new ScanIndex."""
+    with _shared_lock:
+        if _shared:
+            _shared[-1]._deferred.append(func)
+            return
+    index = ScanIndex()
+    try:
+        func(index)
+    finally:
+        index.close()
+
+def _locked(e):
+    "Return whether sqlite3 error e is a timeout waiting for another process's lock."
+    return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+def _tuplize(value):
+    if isinstance(value, list):
+        return tuple(_tuplize(v) for v in value)
+    return value
+
+class ScanIndex(object):
+    """Persistent index of scanned directories, files, and the normalized tags
+    of audio files, keyed by (st_ino, st_mtime) for directories and
+    (st_ino, st_size, st_mtime) for files. Several processes may use the
+    index at once; directories' updates are committed in batches, by
+    maybe_commit(), so an interrupted scan loses little."""
+    def __init__(self, path=None):
+        if path is None:
+            path = default_path()
+        interval = (Config['index_commit'] or '1').strip()
+        if interval.endswith('s'):
+            self._commit_dirs, self._commit_secs = None, float(interval[:-1])
+        else:
+            self._commit_dirs, self._commit_secs = int(interval), None
+        self._uncommitted = 0
+        self._committed = time.time()
+        self._deferred = []
+        #fall back to an index in memory only if the file can't be used at all;
+        #waiting too long for another process's lock is the caller's problem,
+        #since what a memory index stores is thrown away.
+        try:
+            self._connect(path)
+        except sqlite3.Error, e:
+            if _locked(e):
+                raise
+            self._connect(':memory:')
+
+    def _connect(self, path):
+        #WAL lets any number of readers work alongside one writer at a time,
+        #and writers wait for each other rather than failing.
+        self.db = sqlite3.connect(path, timeout=float(Config['index_timeout'] or 60),
+            isolation_level=None)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        #check the schema with the write lock held, so that processes starting
+        #together don't see each other's half-built tables.
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self._create()
+            row = self.db.execute("SELECT value FROM version").fetchone()
+            if row is None or row[0] != repr(db_version):
+                self._clear()
+            self._check_parsers()
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        self.db.isolation_level = ''
+
+    def _create(self):
+        for statement in _schema:
+            self.db.execute(statement)
+
+    def _clear(self):
+        for table in _tables:
+            self.db.execute("DROP TABLE IF EXISTS %s" % table)
+        self._create()
+        self.db.execute("INSERT INTO version (value) VALUES (?)", (repr(db_version), ))
+
+    def _check_parsers(self):
+        """Invalidate the files of each type whose parser_version has changed,
+        so that they, and only they, are parsed again by the next scan, and
+        the files found not to be audio if sniff_version has changed."""
+        db = self.db
+        for kind, version in db.execute("SELECT kind, version FROM parsers").fetchall():
+            current = parser_version(kind)
+            if current == version:
+                continue
+            self._invalidate("kind = ?", (kind, ))
+            db.execute("UPDATE parsers SET version = ? WHERE kind = ?", (current, kind))
+        current = sniff_version()
+        row = db.execute("SELECT value FROM settings WHERE key = 'sniff'").fetchone()
+        if row is None or row[0] != current:
+            self._invalidate("kind IS NULL", ())
+            db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sniff', ?)",
+                (current, ))
+
+    def _invalidate(self, where, args):
+        "Make the next scan look at the files matching condition where again."
+        db = self.db
+        dirs = [row[0] for row in db.execute(
+            "SELECT DISTINCT dir FROM files WHERE " + where, args)]
+        db.execute("UPDATE files SET ino = NULL WHERE " + where, args)
+        #stored subtree hashes and dirty marks would let a scan skip these
+        #directories without looking at their files.
+        stale = set()
+        for path in dirs:
+            while path not in stale and path != os.path.dirname(path):
+                stale.add(path)
+                path = os.path.dirname(path)
+        db.executemany("UPDATE dirs SET tree = NULL WHERE path = ?",
+            ((path, ) for path in stale))
+        now = time.time()
+        db.executemany("INSERT OR REPLACE INTO dirty (path, time) VALUES (?, ?)",
+            ((path, now) for path in dirs))
+
+    def get_dir(self, path):
+        "Return the key stored for directory path, or None if it is not indexed."
+        row = self.db.execute("SELECT ino, mtime FROM dirs WHERE path = ?", (path, )).fetchone()
+        return row and tuple(row)
+
+    def subdirs(self, path):
+        return [row[0] for row in self.db.execute(
+            "SELECT path FROM dirs WHERE parent = ? ORDER BY path", (path, ))]
+
+    def _files(self, where, args):
+        tags = {}
+        for file_id, key, value in self.db.execute(
+                "SELECT tags.file, tags.key, tags.value FROM tags, files "
+                "WHERE tags.file = files.id AND " + where, args):
+            tags.setdefault(file_id, NormMetaData())[key] = json.loads(value)
+        derived = {}
+        for file_id, expr, stamp, inputs, value in self.db.execute(
+                "SELECT files.id, derived.expr, derived.stamp, derived.inputs, derived.value "
+                "FROM derived, files WHERE derived.filename = files.path AND " + where, args):
+            derived.setdefault(file_id, {})[expr] = (stamp, inputs, cPickle.loads(str(value)))
+        result = []
+        for row in self.db.execute(
+                "SELECT id, path, ino, size, mtime, kind, length, bitrate, "
+                "sample_rate, channels, dir FROM files WHERE " + where +
+                " ORDER BY dir, path", args):
+            track = None
+            key = tuple(row[2:5])
+            if row[5] is not None:
+                track = TrackRecord(row[1], row[5], StreamInfo(*row[6:10]),
+                    tags.get(row[0], NormMetaData()), key)
+                track.derived = derived.get(row[0])
+            result.append((row[10], row[1], key, track))
+        return result
+
+    def dir_files(self, path):
+        """Return (path, key, track) for each file indexed in directory path,
+        where track is a TrackRecord, or None for files that are not audio."""
+        return [entry[1:] for entry in self._files("files.dir = ?", (path, ))]
+
+    def subtree_files(self, root):
+        """Return (dir, tracks) for root and each directory below it, with the
+        TrackRecords of each, loading the whole subtree in one pass."""
+        where, args = subtree('path', root)
+        result = {}
+        for row in self.db.execute("SELECT path FROM dirs WHERE " + where, args):
+            result[row[0]] = []
+        for dir_, filename, key, track in self._files(*subtree('files.dir', root)):
+            if track is not None and dir_ in result:
+                result[dir_].append(track)
+        return sorted(result.items())
+
+    def _tree(self, root):
+        where, args = subtree('path', root)
+        dirs = {}
+        for row in self.db.execute("SELECT path, parent, ino, mtime, tree FROM dirs "
+                "WHERE " + where, args):
+            dirs[row[0]] = (row[1], tuple(row[2:4]), row[4])
+        where, args = subtree('dir', root)
+        files = {}
+        for row in self.db.execute("SELECT dir, path, ino, size, mtime FROM files "
+                "WHERE " + where, args):
+            files.setdefault(row[0], []).append((row[1], tuple(row[2:5])))
+        parents = dict((path, entry[0]) for path, entry in dirs.iteritems())
+        return dirs, files, parents
+
+    def update_trees(self, root):
+        "Recompute the stored subtree hashes of root and the directories below it."
+        dirs, files, parents = self._tree(root)
+        hashes = tree_hashes(parents, files, lambda path: dirs[path][1],
+            lambda path, key: key)
+        self.db.executemany("UPDATE dirs SET tree = ? WHERE path = ?",
+            ((h, path) for path, h in hashes.iteritems() if h != dirs[path][2]))
+
+    def trusted_subtrees(self, root, verify_files=True):
+        """Return the topmost directories at or below root whose subtrees are
+        unchanged since their hashes were stored, so that their index entries
+        can be used without visiting them one at a time. Every directory is
+        stat()ed, and every file too if verify_files is set."""
+        dirs, files, parents = self._tree(root)
+        def dir_key(path):
+            try:
+                dst = os.stat(path)
+            except OSError:
+                return None
+            return (dst.st_ino, dst.st_mtime)
+        def file_key(path, key):
+            if not verify_files:
+                return key
+            try:
+                fst = os.stat(path)
+            except OSError:
+                return None
+            return (fst.st_ino, fst.st_size, fst.st_mtime)
+        hashes = tree_hashes(parents, files, dir_key, file_key)
+        trusted = set(path for path, h in hashes.iteritems()
+            if h is not None and h == dirs[path][2])
+        return [path for path in trusted if path == root or parents[path] not in trusted]
+
+    def subtree_dirs(self, root):
+        where, args = subtree('path', root)
+        return [row[0] for row in self.db.execute("SELECT path FROM dirs WHERE " + where, args)]
+
+    def register_watch(self, root, pid):
+        self.db.execute("INSERT OR REPLACE INTO watches (root, pid, state) "
+            "VALUES (?, ?, 'starting')", (root, pid))
+
+    def set_watch_state(self, root, state):
+        self.db.execute("UPDATE watches SET state = ? WHERE root = ?", (state, root))
+
+    def unregister_watch(self, root):
+        self.db.execute("DELETE FROM watches WHERE root = ?", (root, ))
+
+    def watched(self, root):
+        """Return True if a running watcher covers root and has seen every
+        change to it, so that the dirty marks under root are complete."""
+        for wroot, pid, state in self.db.execute("SELECT root, pid, state FROM watches"):
+            if root == wroot or root.startswith(wroot.rstrip('/') + '/'):
+                if state == 'ok' and _alive(pid):
+                    return True
+        return False
+
+    def mark_dirty(self, marks):
+        "Record that each directory in marks, a list of (path, time), changed at time."
+        self.db.executemany("INSERT OR REPLACE INTO dirty (path, time) VALUES (?, ?)", marks)
+
+    def clear_dirty(self, root, before):
+        "Forget changes at or below root that were recorded before time before."
+        where, args = subtree('path', root)
+        self.db.execute("DELETE FROM dirty WHERE time < ? AND " + where, (before, ) + args)
+
+    def clean_subtrees(self, root):
+        """Return the topmost directories at or below root that neither
+        contain nor are below any directory marked dirty, and have been
+        scanned. Only the index is consulted, so this is only valid while
+        root is watched."""
+        where, args = subtree('path', root)
+        parents = {}
+        unclean = set()
+        for path, parent, ino in self.db.execute("SELECT path, parent, ino FROM dirs "
+                "WHERE " + where, args):
+            parents[path] = parent
+            if ino is None:
+                unclean.add(path)
+        dirty = list(unclean) + [row[0] for row in self.db.execute(
+            "SELECT path FROM dirty WHERE " + where, args)]
+        unclean = set()
+        for path in dirty:
+            while path not in unclean:
+                unclean.add(path)
+                if path == root or path == os.path.dirname(path):
+                    break
+                path = os.path.dirname(path)
+        return [path for path in parents if path not in unclean and
+            (path == root or parents[path] in unclean)]
+
+    def _drop_files(self, paths):
+        paths = [(path, ) for path in paths]
+        self.db.executemany("DELETE FROM tags WHERE file IN "
+            "(SELECT id FROM files WHERE path = ?)", paths)
+        self.db.executemany("DELETE FROM files WHERE path = ?", paths)
+
+    def _drop_dir_files(self, where, args):
+        "Remove every file whose dir matches the condition where."
+        self.db.execute("DELETE FROM tags WHERE file IN (SELECT id FROM files "
+            "WHERE %s)" % where, args)
+        self.db.execute("DELETE FROM files WHERE " + where, args)
+
+    def update_dir(self, path, parent, key, stale=(), tracks=(), files=(), replace=False, subdirs=()):
+        """Store directory path and its key, remove the files listed in stale
+        (or all of the directory's files, if replace is set), and store
+        (path, key, record) for each new or changed track and (path, key) for
+        each other file. Subdirectories that are not yet indexed are added
+        without a key, so that they are found but not trusted. Stored
+        expression values are kept for files that are still there, to be
+        checked against their new tags."""
+        db = self.db
+        db.execute("INSERT OR REPLACE INTO dirs (path, parent, ino, mtime) "
+            "VALUES (?, ?, ?, ?)", (path, parent) + tuple(key))
+        db.executemany("INSERT OR IGNORE INTO dirs (path, parent) VALUES (?, ?)",
+            ((subdir, path) for subdir in subdirs))
+        if replace:
+            kept = set(f[0] for f in tracks)
+            kept.update(f[0] for f in files)
+            stale = [row[0] for row in db.execute("SELECT path FROM files WHERE dir = ?",
+                (path, )) if row[0] not in kept]
+            self._drop_dir_files("dir = ?", (path, ))
+        else:
+            self._drop_files(list(stale) + [f[0] for f in tracks] + [f[0] for f in files])
+        db.executemany("DELETE FROM derived WHERE filename = ?", ((f, ) for f in stale))
+        for filename, fkey in files:
+            db.execute("INSERT INTO files (path, dir, ino, size, mtime) "
+                "VALUES (?, ?, ?, ?, ?)", (filename, path) + tuple(fkey))
+        db.executemany("INSERT OR IGNORE INTO parsers (kind, version) VALUES (?, ?)",
+            set((t.kind, parser_version(t.kind)) for filename, fkey, t in tracks))
+        for filename, fkey, t in tracks:
+            info = tuple(getattr(t.info, attr, None) for attr in StreamInfo.__slots__)
+            file_id = db.execute("INSERT INTO files (path, dir, ino, size, "
+                "mtime, kind, length, bitrate, sample_rate, channels) VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, path) + tuple(fkey) + (t.kind, ) + info).lastrowid
+            db.executemany("INSERT INTO tags (file, key, value) VALUES (?, ?, ?)",
+                ((file_id, k, json.dumps(v, default=unicode)) for k, v in t.tags.iteritems()))
+
+    def prune(self, root, keep):
+        """Remove directories at or below root that are not in keep, along with
+        their files, returning the number removed. Everything below a removed
+        directory goes with it, by range, so the cost depends on the size of
+        the removed subtrees rather than on the size of the index."""
+        where, args = subtree('path', root)
+        stale = dict((path, parent) for path, parent in self.db.execute(
+            "SELECT path, parent FROM dirs WHERE " + where, args) if path not in keep)
+        for path, parent in stale.iteritems():
+            if path == root or parent not in stale:
+                self._drop_dir_files(*subtree('dir', path))
+                where, args = subtree('filename', path)
+                self.db.execute("DELETE FROM derived WHERE " + where, args)
+                where, args = subtree('path', path)
+                self.db.execute("DELETE FROM dirs WHERE " + where, args)
+        return len(stale)
+
+    def store_derived(self, values):
+        """Store expression values for tracks, from a list of (path, digest,
+        stamp, inputs, value). Values that can't be pickled aren't stored."""
+        rows = []
+        for filename, digest, stamp, inputs, value in values:
+            try:
+                value = sqlite3.Binary(cPickle.dumps(value, 2))
+            except (cPickle.PicklingError, TypeError):
+                continue
+            rows.append((filename, digest, stamp, inputs, value))
+        self.db.executemany("INSERT OR REPLACE INTO derived (filename, expr, stamp, "
+            "inputs, value) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def set_trackid_source(self, source):
+        "Set the trackid expression source, discarding stored trackids if it has changed."
+        row = self.db.execute("SELECT value FROM settings WHERE key = 'trackid'").fetchone()
+        if row is None or row[0] != source:
+            self.db.execute("DELETE FROM tid_dirs")
+            self.db.execute("DELETE FROM tids")
+            self.db.execute("INSERT OR REPLACE INTO settings (key, value) "
+                "VALUES ('trackid', ?)", (source, ))
+
+    def get_tid_dir(self, path):
+        "Return the key at which the trackids of directory path were stored, or None."
+        row = self.db.execute("SELECT ino, mtime FROM tid_dirs WHERE path = ?", (path, )).fetchone()
+        return row and tuple(row)
+
+    def tid_subdirs(self, path):
+        return [row[0] for row in self.db.execute(
+            "SELECT path FROM tid_dirs WHERE parent = ? ORDER BY path", (path, ))]
+
+    def dir_trackids(self, path):
+        return [_tuplize(json.loads(row[0])) for row in self.db.execute(
+            "SELECT tid FROM tids WHERE dir = ?", (path, ))]
+
+    def set_dir_trackids(self, path, parent, key, tids):
+        "Replace the trackids stored for directory path with tids, a list of (path, tid)."
+        db = self.db
+        db.execute("INSERT OR REPLACE INTO tid_dirs (path, parent, ino, mtime) "
+            "VALUES (?, ?, ?, ?)", (path, parent) + tuple(key))
+        db.execute("DELETE FROM tids WHERE dir = ?", (path, ))
+        db.executemany("INSERT OR REPLACE INTO tids (path, dir, tid) VALUES (?, ?, ?)",
+            ((filename, path, json.dumps(tid, default=unicode)) for filename, tid in tids))
+
+    def add_trackid(self, path, tid, before, after, new=False):
+        """Record that a track with trackid tid has been written to path, which
+        changed the (st_ino, st_mtime) key of its directory from before to
+        after. If the directory's stored key was before, or new says that it
+        was created empty for the write, the stored key becomes after, so that
+        the write doesn't cause it to be rescanned. Otherwise the directory
+        may have other changes that were never scanned, and it is marked stale."""
+        dir_ = os.path.dirname(path)
+        stored = self.get_tid_dir(dir_)
+        if new and stored is None:
+            stored = before
+        if before is None or after is None or stored != tuple(before):
+            after = (None, None)
+        self.db.execute("INSERT OR REPLACE INTO tids (path, dir, tid) VALUES (?, ?, ?)",
+            (path, dir_, json.dumps(tid, default=unicode)))
+        self.db.execute("INSERT OR REPLACE INTO tid_dirs (path, parent, ino, mtime) "
+            "VALUES (?, ?, ?, ?)", (dir_, os.path.dirname(dir_)) + tuple(after))
+
+    def prune_trackids(self, root, keep):
+        "Remove trackids for directories at or below root that are not in keep."
+        where, args = subtree('path', root)
+        stale = dict((path, parent) for path, parent in self.db.execute(
+            "SELECT path, parent FROM tid_dirs WHERE " + where, args) if path not in keep)
+        for path, parent in stale.iteritems():
+            if path == root or parent not in stale:
+                where, args = subtree('dir', path)
+                self.db.execute("DELETE FROM tids WHERE " + where, args)
+                where, args = subtree('path', path)
+                self.db.execute("DELETE FROM tid_dirs WHERE " + where, args)
+
+    def maybe_commit(self):
+        """Note that a directory's changes are complete, and commit if enough
+        directories, or time, have passed since the last commit, according to
+        index_commit."""
+        self._uncommitted += 1
+        if self._commit_secs is None:
+            if self._uncommitted >= self._commit_dirs:
+                self.commit()
+        elif time.time() - self._committed >= self._commit_secs:
+            self.commit()
+
+    def share(self):
+        "Take the writes passed to deferred_write, until closed."
+        with _shared_lock:
+            _shared.append(self)
+
+    def _run_deferred(self):
+        with _shared_lock:
+            deferred, self._deferred = self._deferred, []
+        for func in deferred:
+            func(self)
+
+    def flush(self):
+        """Run the writes queued by deferred_write, to be committed along with
+        this index's own changes, according to index_commit."""
+        if self._deferred:
+            self._run_deferred()
+            self.maybe_commit()
+
+    def commit(self):
+        self._run_deferred()
+        self.db.commit()
+        self._uncommitted = 0
+        self._committed = time.time()
+
+    def close(self):
+        with _shared_lock:
+            if self in _shared:
+                _shared.remove(self)
+        self._run_deferred()
+        self.db.commit()
+        self.db.close()
+
+__all__ = ['ScanIndex', 'deferred_write']
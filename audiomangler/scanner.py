@@ -8,175 +8,571 @@
 ###########################################################################
 import os
 import os.path
+import stat
+import time
+import json
 try:
-    import shelve
+    from os import scandir
 except ImportError:
-    shelve = None
-from audiomangler.config import from_config
-from audiomangler.expression import Expr
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from audiomangler.config import Config, from_config
+from audiomangler.expression import Expr, ExprTuple
+from audiomangler.scanindex import ScanIndex, expr_digest, inputs_digest
+from audiomangler.mutagenext import TrackRecord, audio_extensions, sniff
+from audiomangler.tag import evaluate_many
+from audiomangler.table import TrackTable, numpy
+from audiomangler.logging import msg, WARNING, VERBOSE
+from audiomangler.util import fsdecode, physical_offset, readahead, Prefetcher
 from mutagen import File
-from mutagen import version as mutagen_version
-
-db_version = (mutagen_version, (0, 0))
 
-def scan_track(path, from_dir = ''):
+def scan_track(path, from_dir = '', extensions = None):
     t = None
+    if not sniff(path, extensions):
+        return t
     try:
         t = File(path)
     except Exception: pass
     if t is not None:
+        t = TrackRecord.from_file(t)
         if from_dir:
-            t.relpath = t.filename.replace(from_dir, '', 1).lstrip('/')
-            t.reldir = t.relpath.rsplit('/', 1)
-            if len(t.reldir) > 1:
-                t.reldir = t.reldir[0]
-            else:
-                t.reldir = ''
+            _set_relpath(t, from_dir)
     return t
 
-def scan(items, groupby = None, sortby = None, trackid = None):
-    groupbytxt, sortbytxt, trackidtxt = from_config('groupby', 'sortby', 'trackid')
-    groupby = Expr(groupby or groupbytxt)
-    sortby = Expr(sortby or sortbytxt)
-    trackid = Expr(trackid or trackidtxt)
-    homedir = os.getenv('HOME')
-    if homedir is not None:
-        cachefile = os.path.join(homedir, '.audiomangler')
-        try:
-            os.mkdir(cachefile)
-        except OSError:
-            pass
-        cachefile = os.path.join(cachefile, 'cache')
+def list_dir(path):
+    """Return (path, is_dir, stat) for each directory or regular file in path,
+    sorted by name. Only files are stat()ed; where scandir is available,
+    directories are recognized from the d_type of their entries."""
+    result = []
+    if scandir is not None:
+        for entry in sorted(scandir(path), key=lambda entry: entry.name):
+            try:
+                if entry.is_dir():
+                    result.append((entry.path, True, None))
+                elif entry.is_file():
+                    result.append((entry.path, False, entry.stat()))
+            except OSError:
+                continue
+    else:
+        for filename in sorted(os.listdir(path)):
+            filename = os.path.join(path, filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                result.append((filename, True, None))
+            elif stat.S_ISREG(st.st_mode):
+                result.append((filename, False, st))
+    return result
+
+def _set_relpath(t, from_dir):
+    t.relpath = t.filename.replace(from_dir, '', 1).lstrip('/')
+    t.reldir = t.relpath.rsplit('/', 1)
+    if len(t.reldir) > 1:
+        t.reldir = t.reldir[0]
     else:
-        cachefile = 'audiomangler.cache'
-    dircache = {}
-    if shelve:
+        t.reldir = ''
+
+def read_order(paths, order='name'):
+    """Return the indices of paths in the order they should be read: as given
+    for 'name', by inode number for 'inode', or by the physical location of
+    the start of each file for 'extent'. The latter two save seeks on rotating
+    disks. Files whose extent isn't known, as when the filesystem doesn't
+    support FIEMAP, follow the rest in inode order."""
+    if order not in ('inode', 'extent'):
+        return range(len(paths))
+    keys = []
+    for path in paths:
+        key = (2, 0)
         try:
-            dircache = shelve.open(cachefile, protocol=2)
-        except Exception:
+            if order == 'extent':
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    offset = physical_offset(fd)
+                    key = (1, os.fstat(fd).st_ino) if offset is None else (0, offset)
+                finally:
+                    os.close(fd)
+            else:
+                key = (1, os.stat(path).st_ino)
+        except OSError:
             pass
-    if dircache.get('//version', None) != db_version:
-        dircache.clear()
-        dircache['//version'] = db_version
+        keys.append(key)
+    return sorted(range(len(paths)), key=keys.__getitem__)
+
+def scan_batch(paths, extensions=None, order='name', ahead=0):
+    """Scan paths, returning a track or None for each, in the same order.
+    Files are read in the order given by read_order, and if ahead is set,
+    the kernel is first asked to read ahead that many bytes of each."""
+    indices = read_order(paths, order)
+    if ahead:
+        for i in indices:
+            try:
+                fd = os.open(paths[i], os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                readahead(fd, 0, ahead)
+            finally:
+                os.close(fd)
+    result = [None] * len(paths)
+    for i in indices:
+        result[i] = scan_track(paths[i], extensions=extensions)
+    return result
+
+class _Batch(object):
+    "Files of one or more directories that are scanned together by scan_dirs."
+    __slots__ = 'paths', 'result'
+    def __init__(self):
+        self.paths = []
+        self.result = None
+
+class _Finished(object):
+    "Stand-in for an AsyncResult when a batch was scanned in this process."
+    __slots__ = 'value',
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+def dir_local(groupby):
+    """Return True if albums grouped by groupby never span directories, which
+    is required for scan_albums. This is the case when grouping by dir or
+    reldir, or when the groupby_local config option is set."""
+    if (Config['groupby_local'] or '').lower() in ('1', 'yes', 'true', 'on'):
+        return True
+    return isinstance(groupby, basestring) and groupby.strip() in ('dir', 'reldir')
+
+def scan_dirs(items, jobs = None, extensions = None, recursive = True):
+    """Scan items, yielding (dir, tracks) for each directory as soon as all of
+    its tracks are available. Directories are yielded in walk order whatever
+    the number of jobs. If recursive is false, only the directories given in
+    items are scanned.
+
+    Subtrees whose stored hashes still match are loaded from the index in one
+    pass. With scan_verify set to 'dirs' rather than 'files', only directories
+    are stat()ed to check this, and files that were modified in place without
+    changing their directory's mtime will be missed. While am_watch is running
+    for a root, only the directories it has seen change are visited at all."""
+    jobs, = from_config('jobs')
+    jobs = int(jobs or cpu_count())
+    if extensions is None:
+        extensions = audio_extensions()
+    order = Config['scan_order']
+    ahead = int(Config['scan_readahead'] or 0)
+    threads = int(Config['scan_prefetch_threads'] or 0)
+    index = ScanIndex()
     if isinstance(items, basestring):
         items = (items, )
-    tracks = []
     scanned = set()
-    newdircache = {}
+    visited = set()
+    roots = []
+    changed = []
+    verify_files = Config['scan_verify'] != 'dirs'
+    started = time.time()
     items = map(os.path.abspath, items)
-    for item in items:
-        if item in scanned:
-            continue
-        t = scan_track(item)
-        if t is not None:
-            tracks.append(t)
-            scanned.add(item)
+    #the worker pool is only started once some files need parsing, as a scan
+    #served from the index would spend longer forking it than scanning.
+    pool = []
+    prefetch = threads and Prefetcher(threads, int(Config['scan_prefetch'] or 65536))
+    #with scan_order set, the files of several directories are scanned as one
+    #batch of up to scan_batch files, so that reads are ordered across them.
+    #more directories are then held back, so that batches can fill.
+    size = 0
+    if order in ('inode', 'extent'):
+        size = int(Config['scan_batch'] or 0)
+    window = jobs * 4
+    if size:
+        window = max(window, 64)
+    group = [None]
+    def send():
+        current = group[0]
+        group[0] = None
+        if jobs > 1:
+            if not pool:
+                pool.append(Pool(jobs))
+            current.result = pool[0].apply_async(scan_batch, (current.paths, extensions, order, ahead))
         else:
-            dirs = [item]
-            while dirs:
-                path = dirs.pop(0)
-                try:
-                    dst = os.stat(path)
-                except OSError:
-                    print "unable to stat dir %s" % path
-                    continue
-                cached = dircache.get(path, None)
-                if cached and cached['key'] == (dst.st_ino, dst.st_mtime):
-                    newcached = cached
-                    newtracks = []
-                    newfiles = []
-                    for track in cached['tracks']:
-                        try:
-                            fst = os.stat(track['path'])
-                        except Exception:
-                            continue
-                        if track['key'] == (fst.st_ino, fst.st_size, fst.st_mtime):
-                            newtracks.append(track)
-                            t = track['obj']
-                            t._meta_cache = (False, False)
-                            t.relpath = t.filename.replace(item, '', 1).lstrip('/')
-                            t.reldir = t.relpath.rsplit('/', 1)
-                            if len(t.reldir) > 1:
-                                t.reldir = t.reldir[0]
-                            else:
-                                t.reldir = ''
-                            tracks.append(t)
-                        else:
-                            t = scan_track(track['path'])
-                            if t is not None:
-                                tracks.append(t)
-                                newtracks.append({'path':track['path'], 'obj':t, 'key':(fst.st_ino, fst.st_size, fst.st_mtime)})
-                    for file_ in cached['files']:
-                        try:
-                            fst = os.stat(file_['path'])
-                        except Exception:
-                            continue
-                        if file_['key'] == (fst.st_ino, fst.st_size, fst.st_mtime):
-                            newfiles.append(file_)
-                        else:
-                            t = scan_track(file_['path'])
-                            if t is not None:
-                                tracks.append(t)
-                                newtracks.append({'path':file_['path'], 'obj':t, 'key':(fst.st_ino, fst.st_size, fst.st_mtime)})
-                            else:
-                                newfiles.append({'path':file_['path'], 'key':(fst.st_ino, fst.st_size, fst.st_mtime)})
-                    newcached['tracks'] = newtracks
-                    newcached['files'] = newfiles
-                else:
-                    newcached = {'tracks':[], 'dirs':[], 'files':[]}
-                    newcached['key'] = (dst.st_ino, dst.st_mtime)
+            current.result = _Finished(scan_batch(current.paths, extensions, order, ahead))
+    #one entry per directory, with its files that need parsing if any, kept in
+    #walk order so that results don't depend on when a batch completes.
+    pending = deque()
+    def submit(path, entry, found, batch=(), root=''):
+        current = start = None
+        if batch:
+            paths = [filename for filename, key in batch]
+            if prefetch:
+                prefetch.add(paths)
+            if group[0] is None:
+                group[0] = _Batch()
+            current = group[0]
+            start = len(current.paths)
+            current.paths.extend(paths)
+            if len(current.paths) >= size:
+                send()
+        pending.append((path, entry, found, batch, current, start, root))
+    def collect(limit):
+        while len(pending) > limit:
+            path, entry, found, batch, current, start, root = pending.popleft()
+            newtracks = []
+            newfiles = []
+            if batch:
+                if current.result is None:
+                    send()
+                result = current.result.get()[start:start + len(batch)]
+                for (filename, fkey), t in zip(batch, result):
+                    if t is not None:
+                        t.key = fkey
+                        _set_relpath(t, root)
+                        found.append(t)
+                        newtracks.append((filename, fkey, t))
+                    else:
+                        newfiles.append((filename, fkey))
+            if entry:
+                #the directory is only stored once all of its files are, so an
+                #interrupted scan never leaves a valid key over partial contents.
+                #commits are frequent enough that one loses little work, and
+                #other scans can see what has been done and write in between.
+                parent, key, stale, replace, subdirs = entry
+                if batch or stale or replace:
+                    index.update_dir(path, parent, key, stale, newtracks, newfiles, replace, subdirs)
+                    index.maybe_commit()
+                    changed.append(path)
+            #the consumer may take its time over each directory, and may write
+            #to the index itself, as the sync code does from its threads. those
+            #writes are queued on this index, see deferred_write.
+            index.flush()
+            yield path, found
+    try:
+        index.share()
+        for item in items:
+            if item in scanned or item in visited:
+                continue
+            t = scan_track(item, extensions=extensions)
+            if t is not None:
+                submit(os.path.dirname(item), None, [t])
+                scanned.add(item)
+            else:
+                roots.append(item)
+                trusted = ()
+                if recursive and index.watched(item):
+                    trusted = set(index.clean_subtrees(item))
+                elif recursive:
+                    trusted = set(index.trusted_subtrees(item, verify_files))
+                dirs = [(item, os.path.dirname(item))]
+                while dirs:
+                    path, parent = dirs.pop(0)
+                    if path in visited:
+                        continue
+                    if path in trusted:
+                        for dir_, found in index.subtree_files(path):
+                            visited.add(dir_)
+                            for t in found:
+                                _set_relpath(t, item)
+                            submit(dir_, None, found)
+                        for result in collect(window):
+                            yield result
+                        continue
                     try:
-                        paths = (os.path.join(path, f) for f in sorted(os.listdir(path)))
+                        dst = os.stat(path)
                     except OSError:
+                        print "unable to stat dir %s" % path
                         continue
-                    for filename in paths:
-                        if filename in scanned:
-                            continue
-                        else:
-                            scanned.add(filename)
-                        if os.path.isdir(filename):
-                            newcached['dirs'].append(filename)
-                        elif os.path.isfile(filename):
+                    visited.add(path)
+                    key = (dst.st_ino, dst.st_mtime)
+                    batch = []
+                    stale = []
+                    found = []
+                    if index.get_dir(path) == key:
+                        replace = False
+                        subdirs = index.subdirs(path)
+                        for filename, fkey, t in index.dir_files(path):
                             try:
                                 fst = os.stat(filename)
                             except Exception:
+                                stale.append(filename)
                                 continue
-                            t = scan_track(filename)
-                            if t is not None:
-                                tracks.append(t)
-                                newcached['tracks'].append({'path':filename, 'obj':t, 'key':(fst.st_ino, fst.st_size, fst.st_mtime)})
-                            else:
-                                newcached['files'].append({'path':filename, 'key':(fst.st_ino, fst.st_size, fst.st_mtime)})
-                        else:
+                            newkey = (fst.st_ino, fst.st_size, fst.st_mtime)
+                            if fkey != newkey:
+                                batch.append((filename, newkey))
+                            elif t is not None:
+                                _set_relpath(t, item)
+                                found.append(t)
+                    else:
+                        replace = True
+                        subdirs = []
+                        try:
+                            entries = list_dir(path)
+                        except OSError:
                             continue
-                dirs.extend(newcached['dirs'])
-                newdircache[path] = newcached
-    for item in items:
-        for key in dircache.keys():
-            if key.startswith(item):
-                del dircache[key]
-    dircache.update(newdircache)
-    if hasattr(dircache, 'close'):
-        dircache.close()
+                        #only files go into scanned: a directory listed here may
+                        #also be one of items, as target_trackids passes them
+                        #when not recursive, and visited covers the rest.
+                        for filename, isdir, fst in entries:
+                            if isdir:
+                                subdirs.append(filename)
+                            elif filename not in scanned:
+                                scanned.add(filename)
+                                batch.append((filename, (fst.st_ino, fst.st_size, fst.st_mtime)))
+                    submit(path, (parent, key, stale, replace, subdirs), found, batch, item)
+                    for result in collect(window):
+                        yield result
+                    if recursive:
+                        dirs.extend((subdir, path) for subdir in subdirs)
+        for result in collect(0):
+            yield result
+        if recursive:
+            for root in roots:
+                if index.prune(root, visited) or changed:
+                    index.update_trees(root)
+                index.clear_dirty(root, started)
+    finally:
+        #also when the consumer stops early, so that writes queued on this
+        #index aren't lost, and later ones aren't queued on it.
+        index.close()
+        if pool:
+            pool[0].terminate()
+            pool[0].join()
+        if prefetch:
+            prefetch.close()
+
+def target_trackids(base = None, trackid = None, jobs = None):
+    """Return the set of trackids of the tracks below base, the sync target.
+    Trackids are kept in the scan index per directory, and only directories
+    whose (st_ino, st_mtime) has changed since are rescanned; the sync code
+    records the files it writes as it goes."""
+    base, trackidtxt = from_config('base', 'trackid')
+    trackid = Expr(trackid or trackidtxt)
+    base = os.path.abspath(base)
+    index = ScanIndex()
+    index.set_trackid_source(trackid._source)
+    tids = set()
+    changed = []
+    visited = set()
+    dirs = [(base, os.path.dirname(base))]
+    while dirs:
+        path, parent = dirs.pop(0)
+        try:
+            dst = os.stat(path)
+        except OSError:
+            continue
+        visited.add(path)
+        key = (dst.st_ino, dst.st_mtime)
+        if index.get_tid_dir(path) == key:
+            tids.update(index.dir_trackids(path))
+            subdirs = index.tid_subdirs(path)
+        else:
+            try:
+                subdirs = [filename for filename, isdir, fst in list_dir(path) if isdir]
+            except OSError:
+                continue
+            changed.append((path, parent, key))
+        dirs.extend((subdir, path) for subdir in subdirs)
+    if changed:
+        index.commit()
+        found = dict(scan_dirs([path for path, parent, key in changed], jobs, recursive=False))
+        for path, parent, key in changed:
+            tracks = found.get(path, ())
+            dirtids = zip([t.filename for t in tracks],
+                evaluate_many(trackid, [t.meta for t in tracks]))
+            index.set_dir_trackids(path, parent, key, dirtids)
+            index.maybe_commit()
+            tids.update(tid for filename, tid in dirtids)
+    index.prune_trackids(base, visited)
+    index.close()
+    return tids
+
+def _stamp(t):
+    "Return a string identifying the file and relpath of track t, if it has a key."
+    if t.key is None:
+        return None
+    ino, size, mtime = t.key
+    return '%d %d %r %s' % (ino, size, mtime, getattr(t, 'relpath', None))
+
+def _derive(tracks, keys, digests, new):
+    """Return the values of keys, an ExprTuple, for each of tracks. A value
+    stored in the index under its digest is used if it was stored for the
+    same file and relpath, or if the fields its expression reads are
+    unchanged, as after retagging some other field. The values of the other
+    tracks are evaluated together in one batch and added to new for storing."""
+    result = []
+    stale = []
+    for t in tracks:
+        stamp = _stamp(t)
+        derived = t.derived or {}
+        values = []
+        restamped = []
+        flat = None
+        for expr, digest in zip(keys._exprs, digests):
+            stored = derived.get(digest)
+            if stored is None:
+                break
+            if stamp is None or stored[0] != stamp:
+                if flat is None:
+                    flat = t.meta.flat(None, keys.fields)
+                inputs = inputs_digest(expr, flat)
+                if inputs is None or inputs != stored[1]:
+                    break
+                restamped.append((t.filename, digest, stamp, inputs, stored[2]))
+            values.append(stored[2])
+        else:
+            new.extend(restamped)
+            result.append(values)
+            continue
+        if flat is None:
+            flat = t.meta.flat(None, keys.fields)
+        stale.append((len(result), t.filename, stamp, flat))
+        result.append(None)
+    if stale:
+        evaluated = keys.evaluate_many([flat for i, filename, stamp, flat in stale])
+        for (i, filename, stamp, flat), values in zip(stale, evaluated):
+            result[i] = values
+            new.extend((filename, digest, stamp, inputs_digest(expr, flat), value)
+                for expr, digest, value in zip(keys._exprs, digests, values))
+    return result
+
+def _store_derived(new):
+    if new:
+        index = ScanIndex()
+        index.store_derived(new)
+        index.close()
+
+def _scan_keys(items, groupby, sortby, trackid, jobs):
+    """Scan items, returning the tracks found, with sortkey and tid set, and
+    their groupby values."""
+    groupbytxt, sortbytxt, trackidtxt = from_config('groupby', 'sortby', 'trackid')
+    groupby = Expr(groupby or groupbytxt)
+    sortby = Expr(sortby or sortbytxt)
+    trackid = Expr(trackid or trackidtxt)
+    exprs = ExprTuple((groupby, sortby, trackid))
+    digests = [expr_digest(expr) for expr in (groupby, sortby, trackid)]
+    tracks = [t for path, found in scan_dirs(items, jobs) for t in found]
+    groups = []
+    new = []
+    for t, values in zip(tracks, _derive(tracks, exprs, digests, new)):
+        group, t.sortkey, t.tid = values
+        groups.append(group)
+    _store_derived(new)
+    return tracks, groups
+
+def scan_table(items, groupby = None, sortby = None, trackid = None, jobs = None):
+    """Scan items, returning a TrackTable of the tracks found, with columns
+    'group', 'sort' and 'tid' holding the values of the groupby, sortby and
+    trackid expressions. Needs NumPy."""
+    tracks, groups = _scan_keys(items, groupby, sortby, trackid, jobs)
+    table = TrackTable(tracks)
+    table.add_column('group', groups)
+    table.add_column('sort', [t.sortkey for t in tracks])
+    table.add_column('tid', [t.tid for t in tracks])
+    return table
+
+def _jsonable(value):
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+class CollisionReport(dict):
+    """Tracks that share a trackid, mapping each such trackid to the tracks
+    that have it, in scan order. scan() keeps the last of them in its
+    trackids."""
+    def dump(self, f):
+        "Write the report to file f as JSON lines, one per trackid."
+        for tid in sorted(self):
+            tracks = self[tid]
+            f.write(json.dumps({
+                'trackid': _jsonable(tid),
+                'kept': fsdecode(tracks[-1].filename),
+                'files': [fsdecode(t.filename) for t in tracks],
+            }) + '\n')
+
+    def report(self):
+        "Log each collision, and a summary; write the report to collision_report if set."
+        for tid in sorted(self):
+            msg(consoleformat=u"trackid collision: %(files)s",
+                format="collision: %(tid)r %(paths)r", tid=tid,
+                paths=[t.filename for t in self[tid]],
+                files=u', '.join(fsdecode(t.filename) for t in self[tid]), loglevel=VERBOSE)
+        if self:
+            msg(consoleformat=u"WARNING: %(count)d trackids are shared by more than one track",
+                format="collisions: %(count)d", count=len(self), loglevel=WARNING)
+        path = Config['collision_report']
+        if path:
+            f = open(path, 'w')
+            try:
+                self.dump(f)
+            finally:
+                f.close()
+
+def scan(items, groupby = None, sortby = None, trackid = None, jobs = None):
+    """Scan items, returning (albums, dirs, trackids, collisions): tracks by
+    groupby value and by directory, each sorted by sortby, each track by
+    trackid, and a CollisionReport of the trackids that more than one track
+    has."""
+    collisions = CollisionReport()
+    if numpy is not None:
+        table = scan_table(items, groupby, sortby, trackid, jobs)
+        collisions.update(table.duplicates('tid'))
+        collisions.report()
+        albums = dict(table.groups('group', 'sort'))
+        dirs = dict(table.groups('dir', 'sort'))
+        trackids = dict((t.tid, t) for t in table.tracks)
+        return albums, dirs, trackids, collisions
+    tracks, groups = _scan_keys(items, groupby, sortby, trackid, jobs)
     albums = {}
     dirs = {}
     trackids = {}
-    for t in tracks:
-        t.sortkey = t.meta.evaluate(sortby)
-        albums.setdefault(t.meta.evaluate(groupby), []).append(t)
+    for t, group in zip(tracks, groups):
+        albums.setdefault(group, []).append(t)
         dirs.setdefault(os.path.split(t.filename)[0], []).append(t)
-        t.tid = t.meta.evaluate(trackid)
         if t.tid in trackids:
-            print "trackid collision"
-            print t.filename
-            print trackids[t.tid].filename
+            collisions.setdefault(t.tid, [trackids[t.tid]]).append(t)
         trackids[t.tid] = t
+    collisions.report()
     #trying not to evaluate sort expressions for every comparison. don't modify
     #metadata during sort. ;)
     for v in albums.itervalues():
         v.sort(lambda x, y: cmp(x.sortkey, y.sortkey))
     for v in dirs.itervalues():
         v.sort(lambda x, y: cmp(x.sortkey, y.sortkey))
-    return albums, dirs, trackids
+    return albums, dirs, trackids, collisions
+
+def scan_albums(items, groupby = None, sortby = None, jobs = None):
+    """Scan items, yielding each album, sorted, as soon as the directory that
+    holds it has been scanned. The groupby expression must be directory-local
+    (see dir_local); an album that turns up in more than one directory is
+    reported and yielded once per directory."""
+    groupbytxt, sortbytxt = from_config('groupby', 'sortby')
+    groupby = Expr(groupby or groupbytxt)
+    sortby = Expr(sortby or sortbytxt)
+    exprs = ExprTuple((groupby, sortby))
+    digests = [expr_digest(groupby), expr_digest(sortby)]
+    seen = set()
+    new = []
+    for path, found in scan_dirs(items, jobs):
+        albums = {}
+        keys = []
+        for t, values in zip(found, _derive(found, exprs, digests, new)):
+            key, t.sortkey = values
+            if key not in albums:
+                albums[key] = []
+                keys.append(key)
+            albums[key].append(t)
+        for key in keys:
+            if key in seen:
+                msg(consoleformat=u"WARNING: album %(key)r is split across directories, including %(dir_p)s",
+                    format="split album: %(key)r, %(dir_)r",
+                    key=key, dir_=path, dir_p=fsdecode(path), loglevel=WARNING)
+            seen.add(key)
+            album = albums[key]
+            album.sort(lambda x, y: cmp(x.sortkey, y.sortkey))
+            yield album
+    _store_derived(new)
 
-__all__ = ['scan']
\ No newline at end of file
+__all__ = ['scan', 'scan_table', 'CollisionReport', 'scan_albums', 'scan_dirs', 'scan_track', 'dir_local', 'target_trackids']
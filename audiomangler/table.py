@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+import os.path
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def categorical(values):
+    """Return (codes, categories) for a sequence of values: categories is the
+    sorted list of distinct values and codes an array of their indices, so
+    that codes compare as the values do."""
+    try:
+        categories = sorted(set(values))
+    except TypeError:
+        #unhashable values, such as lists from a sort expression
+        codes = numpy.empty(len(values), numpy.int32)
+        categories = []
+        for i in sorted(xrange(len(values)), key=values.__getitem__):
+            if not categories or values[i] != categories[-1]:
+                categories.append(values[i])
+            codes[i] = len(categories) - 1
+        return codes, categories
+    index = dict((value, i) for i, value in enumerate(categories))
+    codes = numpy.fromiter((index[value] for value in values), numpy.int32, len(values))
+    return codes, categories
+
+class TrackTable(object):
+    """Columnar table of tracks. Each column is stored as categorical codes, so
+    that grouping, sorting and finding duplicates work on integer arrays
+    rather than on the tracks one at a time. Columns are added with
+    add_column, or built on first use from the tracks' normalized fields;
+    'dir' holds the directory of each track. The tracks themselves stay in
+    tracks, in their original order. Needs NumPy."""
+    def __init__(self, tracks):
+        if numpy is None:
+            raise ImportError("TrackTable needs NumPy")
+        self.tracks = list(tracks)
+        self._columns = {}
+        self._flat = None
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add_column(self, name, values):
+        self._columns[name] = categorical(list(values))
+
+    def column(self, name):
+        "Return (codes, categories) for column name."
+        if name not in self._columns:
+            if name == 'dir':
+                values = [os.path.split(t.filename)[0] for t in self.tracks]
+            else:
+                if self._flat is None:
+                    self._flat = [t.meta.flat() for t in self.tracks]
+                values = [flat.get(name) for flat in self._flat]
+            self.add_column(name, values)
+        return self._columns[name]
+
+    def _runs(self, order, codes):
+        "Split order, sorted by codes, into runs of equal codes."
+        if not len(order):
+            return []
+        sorted_codes = codes[order]
+        return numpy.split(order, numpy.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1)
+
+    def groups(self, by, sortby=None):
+        """Return (value, tracks) for each distinct value of column by, in order
+        of value, with each group's tracks ordered by column sortby, if given,
+        and otherwise in their original order."""
+        codes, categories = self.column(by)
+        if sortby is None:
+            order = numpy.argsort(codes, kind='mergesort')
+        else:
+            order = numpy.lexsort((self.column(sortby)[0], codes))
+        return [(categories[codes[run[0]]], [self.tracks[i] for i in run])
+            for run in self._runs(order, codes)]
+
+    def duplicates(self, by):
+        """Return (value, tracks) for each value of column by that more than one
+        track has, with the tracks in their original order."""
+        codes, categories = self.column(by)
+        dup = numpy.flatnonzero(numpy.bincount(codes)[codes] > 1)
+        order = dup[numpy.argsort(codes[dup], kind='mergesort')]
+        return [(categories[codes[run[0]]], [self.tracks[i] for i in run])
+            for run in self._runs(order, codes)]
+
+__all__ = ['TrackTable', 'categorical']
@@ -499,12 +499,18 @@ class NormMetaData(dict):
                     del newmeta[k]
             return cls(newmeta)
 
-    def flat(self, newmeta = None):
+    def flat(self, newmeta = None, fields = None):
+        """Return a copy with list values joined into strings, with only the keys
+        in fields, if given, such as the fields of the expression it is for."""
         if newmeta is None:
             newmeta = self.__class__()
+        if fields is None:
+            items = self.iteritems()
+        else:
+            items = ((key, self[key]) for key in fields if key in self)
         #we assume here that all items are numeric, a string, a list of
         #strings, or a list of associations.
-        for key, value in self.iteritems():
+        for key, value in items:
             if isinstance(value, (list, tuple)):
                 if not reduce(and_, (isinstance(i, basestring) for i in value)):
                     value = (': '.join(i) for i in value)
@@ -512,11 +518,12 @@ class NormMetaData(dict):
             newmeta[key] = value
         #make sure the numeric members *always* have numeric values
         for k in ('tracknumber', 'totaltracks', 'discnumber', 'totaldiscs'):
-            newmeta.setdefault(k, 0)
+            if fields is None or k in fields:
+                newmeta.setdefault(k, 0)
         return newmeta
 
     def evaluate(self, expr, d = None):
-        return evaluate(expr, self.flat(d))
+        return evaluate(expr, self.flat(d, getattr(expr, 'fields', None)))
 
     def apply(self, target, clear=False):
         if target.tags is None:
@@ -551,4 +558,10 @@ class NormMetaData(dict):
             print newmeta
             target.tags.update(newmeta)
 
-__all__ = ['NormMetaData']
\ No newline at end of file
+def evaluate_many(expr, metas):
+    """Return a list of the values of expr, an Expr, for each NormMetaData in
+    metas, flattening only the fields it reads."""
+    fields = expr.fields
+    return expr.evaluate_many([meta.flat(None, fields) for meta in metas])
+
+__all__ = ['NormMetaData', 'evaluate_many']
\ No newline at end of file
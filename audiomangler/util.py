@@ -7,9 +7,28 @@
 #
 ###########################################################################
 import os, stat
+import fcntl
+from array import array
+import struct
+import ctypes
+import ctypes.util
+from threading import Thread, Lock
+from Queue import Queue, Full, Empty
 from audiomangler.config import Config
 from audiomangler.logging import msg, err, fatal, WARNING, ERROR
 
+try:
+    _fadvise = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+        use_errno=True).posix_fadvise
+    _fadvise.argtypes = (ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int)
+except (OSError, AttributeError):
+    _fadvise = None
+
+POSIX_FADV_WILLNEED = 3
+FS_IOC_FIEMAP = 0xC020660B
+_fiemap = struct.Struct('QQIIII')
+_fiemap_extent = struct.Struct('QQQQQIIII')
+
 class ClassInitMeta(type):
     def __new__(cls, name, bases, cls_dict):
         class_init = cls_dict.get('__classinit__', None)
@@ -68,10 +87,145 @@ def test_splits(dir_list, allowedcodecs=None, targetcodec=None):
                 fatal(consoleformat=u"tracks in %(dir_p)s would be placed in different target directories, aborting\nset onsplit to 'warn' or 'ignore' to proceed anyway",
                     format="split: %(dir_)r", dir_=dir_, dir_p=fsdecode(dir_), nologerror=1)
 
+def physical_offset(fd):
+    """Return the physical offset of the first extent of the file open as fd,
+    using FIEMAP, or None if the filesystem can't report it."""
+    buf = array('B', _fiemap.pack(0, (1 << 64) - 1, 0, 0, 1, 0) + '\0' * _fiemap_extent.size)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except (IOError, OSError):
+        return None
+    if not _fiemap.unpack_from(buf)[3]:
+        return None
+    return _fiemap_extent.unpack_from(buf, _fiemap.size)[1]
+
+def readahead(fd, offset, length):
+    "Ask the kernel to start reading a region of the file open as fd."
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+
+class Prefetcher(object):
+    """Bounded pool of threads that read the first and last size bytes of
+    files into the page cache before they are parsed. On high-latency
+    filesystems this overlaps the round trips for many files, which parsing
+    one file at a time can't do. Files are dropped, rather than waited for,
+    once backlog of them are queued."""
+    def __init__(self, threads, size, backlog=1024):
+        self.size = size
+        self.queue = Queue(backlog)
+        self.threads = []
+        for i in range(threads):
+            thread = Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, paths):
+        for path in paths:
+            try:
+                self.queue.put_nowait(path)
+            except Full:
+                break
+
+    def _run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                tail = max(os.fstat(fd).st_size - self.size, 0)
+                readahead(fd, 0, self.size)
+                if tail:
+                    readahead(fd, tail, self.size)
+                os.read(fd, self.size)
+                if tail > self.size:
+                    os.lseek(fd, tail, os.SEEK_SET)
+                    os.read(fd, self.size)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+    def close(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class LRUCache(object):
+    """Dict-like cache holding at most size items. When it grows past size,
+    the least recently used items are dropped, down to three quarters of
+    size, so that the cost of finding them is spread over many insertions.
+    Hits, misses and evictions are counted, for tuning size. It may be shared
+    between threads, as the expression caches are with the sync workers.
+    size may be a function returning it, such as a lookup of a setting that
+    is only known once the configuration has been read."""
+    def __init__(self, size):
+        self._size = size
+        self.lock = Lock()
+        self.data = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self):
+        size = self._size() if callable(self._size) else self._size
+        return max(int(size), 1)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.tick += 1
+            self.data[key] = (item[0], self.tick)
+            return item[0]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.tick += 1
+            self.data[key] = (value, self.tick)
+            size = self.size
+            if len(self.data) > size:
+                data = self.data
+                stale = sorted(data, key=lambda key: data[key][1])
+                for key in stale[:len(data) - size * 3 // 4]:
+                    del data[key]
+                    self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'items': len(self.data), 'size': self.size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
 def fsencode(string):
     return string.encode(Config['fs_encoding'], Config.get('fs_encoding_err', 'underscorereplace'))
 
 def fsdecode(string):
     return string.decode(Config['fs_encoding'], Config.get('fs_encoding_err', 'replace'))
 
-__all__ = ['copy', 'move', 'fsencode', 'fsdecode', 'test_splits']
\ No newline at end of file
+__all__ = ['copy', 'move', 'fsencode', 'fsdecode', 'test_splits', 'physical_offset', 'LRUCache',
+    'readahead', 'Prefetcher']
\ No newline at end of file
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+import os
+import os.path
+import errno
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
+from sqlite3 import OperationalError
+from audiomangler.config import Config
+from audiomangler.scanindex import ScanIndex
+from audiomangler.scanner import list_dir, scan_dirs
+from audiomangler.logging import msg, err, INFO, VERBOSE, WARNING
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+watch_mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_event = struct.Struct('iIII')
+
+class Inotify(object):
+    "Minimal ctypes binding for Linux inotify, tracking the path of each watch."
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.paths = {}
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, path, watch_mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+        return wd
+
+    def add_tree(self, root):
+        "Watch root and every directory below it, returning the number of failures."
+        failed = 0
+        dirs = [root]
+        while dirs:
+            path = dirs.pop()
+            try:
+                self.add_watch(path)
+                dirs.extend(filename for filename, isdir, fst in list_dir(path) if isdir)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    err(consoleformat=u"unable to watch %(path)r: %(error)s",
+                        format="watch failed: %(path)r", path=path, error=e.strerror)
+                    failed += 1
+        return failed
+
+    def read(self, timeout=None):
+        "Wait up to timeout seconds for events, returning a list of (path, mask, name)."
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = _event.unpack_from(buf, pos)
+            pos += _event.size
+            name = buf[pos:pos + length].rstrip('\0')
+            pos += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def _resync(index, roots):
+    "Return every directory below roots that no longer matches its stored subtree hash."
+    verify_files = Config['scan_verify'] != 'dirs'
+    result = []
+    for root in roots:
+        trusted = index.trusted_subtrees(root, verify_files)
+        dirty = [path for path in index.subtree_dirs(root)
+            if not any(path == t or path.startswith(t.rstrip('/') + '/') for t in trusted)]
+        result.extend(dirty)
+        msg(consoleformat=u"rescanned %(root)r after overflow, %(count)d directories changed",
+            format="resync: %(root)r %(count)d", root=root, count=len(dirty), loglevel=INFO)
+    return result
+
+def _flush(index, pending, roots=(), state=None):
+    """Mark the directories in pending dirty, and set the state of roots, in
+    one transaction, returning whether the index took them. Marks are made as
+    of now, not as of the change: a scan that started in between trusted the
+    index without them, and clears only the marks made before it started."""
+    now = time.time()
+    try:
+        index.mark_dirty([(path, now) for path in pending])
+        for root in roots:
+            index.set_watch_state(root, state)
+        index.commit()
+    except OperationalError:
+        #the index is locked by a scan; keep the changes for later
+        index.db.rollback()
+        return False
+    pending.clear()
+    return True
+
+def watch(roots, interval=1.0):
+    """Watch roots with inotify, recording changed directories in the scan
+    index so that scan() only needs to revalidate those, for as long as this
+    runs. If the kernel's event queue overflows, the roots are checked against
+    their stored subtree hashes and the directories that differ are marked."""
+    roots = [os.path.abspath(root) for root in roots]
+    inotify = Inotify()
+    index = ScanIndex()
+    pid = os.getpid()
+    failed = 0
+    for root in roots:
+        index.register_watch(root, pid)
+        failed += inotify.add_tree(root)
+    index.commit()
+    #bring the index up to date with anything that changed before the watches
+    #were in place; changes from here on are caught as events.
+    for result in scan_dirs(roots):
+        pass
+    state = 'partial' if failed else 'ok'
+    for root in roots:
+        index.set_watch_state(root, state)
+    index.commit()
+    msg(consoleformat=u"watching %(roots)r", format="watch: %(roots)r", roots=roots, loglevel=INFO)
+    pending = set()
+    #whether state has changed since it was last written to the index; it is
+    #only written along with the marks for the changes seen before it.
+    report = False
+    flushed = time.time()
+    try:
+        while True:
+            for path, mask, name in inotify.read(interval):
+                if mask & IN_Q_OVERFLOW:
+                    msg(consoleformat=u"WARNING: inotify queue overflowed, rescanning",
+                        format="overflow", loglevel=WARNING)
+                    for root in roots:
+                        index.set_watch_state(root, 'overflow')
+                    index.commit()
+                    failed = sum(inotify.add_tree(root) for root in roots)
+                    pending.update(_resync(index, roots))
+                    state = 'partial' if failed else 'ok'
+                    report = True
+                    continue
+                if path is None:
+                    continue
+                pending.add(path)
+                if mask & IN_ISDIR and name:
+                    subdir = os.path.join(path, name)
+                    pending.add(subdir)
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        if inotify.add_tree(subdir) and state == 'ok':
+                            state = 'partial'
+                            report = True
+                msg(consoleformat=u"changed: %(path)r", format="changed: %(path)r", path=os.path.join(path, name), loglevel=VERBOSE)
+            if report or pending and time.time() - flushed >= interval:
+                if _flush(index, pending, roots if report else (), state):
+                    report = False
+                flushed = time.time()
+    finally:
+        if pending:
+            _flush(index, pending)
+        for root in roots:
+            index.unregister_watch(root)
+        index.close()
+        inotify.close()
+
+__all__ = ['watch', 'Inotify']
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Time evaluating the expressions timed by expr_trusted.py, and the
+scanner's keys as an ExprTuple, over flattened metadata for many tracks,
+calling evaluate once per record against one call of evaluate_many, in
+restricted and trusted mode. evaluate_many is also timed given the records
+as a dict of columns, which includes building the rows from them.
+
+usage: expr_many.py [records [repeat]]"""
+import sys
+import time
+from expr_trusted import records, templates
+from audiomangler.config import Config
+from audiomangler.expression import ExprTuple
+
+def columns(data):
+    keys = set()
+    for cdict in data:
+        keys.update(cdict)
+    return dict((key, [cdict.get(key) for cdict in data]) for key in keys)
+
+def best(func, repeat):
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        result = elapsed if result is None else min(result, elapsed)
+    return result
+
+def measure(name, expr, data, cols, repeat):
+    count = len(data)
+    evaluate = expr.evaluate
+    assert [evaluate(cdict) for cdict in data[:100]] == list(expr.evaluate_many(data[:100]))
+    single = best(lambda: [evaluate(cdict) for cdict in data], repeat)
+    many = best(lambda: expr.evaluate_many(data), repeat)
+    column = best(lambda: expr.evaluate_many(cols), repeat)
+    print "%-9s %-10s evaluate %6.2fus  many %6.2fus  %4.1fx  columns %6.2fus" % (
+        name, 'trusted' if expr._trusted else 'restricted', single * 1e6 / count,
+        many * 1e6 / count, single / many, column * 1e6 / count)
+
+def main(count=100000, repeat=3):
+    data = records(count)
+    cols = columns(data)
+    sources = [Config['groupby'], Config['sortby'], Config['trackid']]
+    for trusted in (False, True):
+        for name, cls, source in templates():
+            measure(name, cls(source, trusted=trusted), data, cols, repeat)
+        measure('keys', ExprTuple(sources, trusted=trusted), data, cols, repeat)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        print __doc__
+        sys.exit(1)
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Time evaluating the default filename, groupby, sortby and trackid
+expressions, and the transcoder's track id template, in restricted and
+trusted mode over flattened metadata like that of a generated library (see
+mklib.py). The scanner's keys are also timed evaluated one at a time and
+together as an ExprTuple. The statistics of the expression cache and of the
+filename template's cache of directories are printed at the end.
+
+usage: expr_trusted.py [records [repeat]]"""
+import sys
+import time
+import random
+import mklib
+from audiomangler.config import Config
+from audiomangler.expression import Expr, ExprTuple, FileFormat
+from audiomangler.audiocodecs import idexpr
+
+def records(count, seed=0):
+    rnd = random.Random(seed)
+    result = []
+    while len(result) < count:
+        album = mklib.album_meta(rnd)
+        total = rnd.randint(5, 15)
+        path = u'/music/%s/%s' % (album['albumartist'], album['album'])
+        for number in range(1, total + 1):
+            meta = mklib.track_meta(rnd, album, number, total)
+            ext = rnd.choice(sorted(mklib.writers))
+            meta.update({
+                'discnumber': 0,
+                'totaldiscs': 0,
+                'ext': ext,
+                'type': ext,
+                'dir': path,
+                'name': u'%02d %s.%s' % (number, meta['title'], ext),
+            })
+            meta['path'] = meta['filename'] = u'%s/%s' % (path, meta['name'])
+            result.append(meta)
+    return result[:count]
+
+def templates():
+    return [
+        ('filename', FileFormat, Config['filename']),
+        ('groupby', Expr, Config['groupby']),
+        ('sortby', Expr, Config['sortby']),
+        ('trackid', Expr, Config['trackid']),
+        ('idexpr', type(idexpr), idexpr._source),
+    ]
+
+class Separate(object):
+    """Evaluate exprs one at a time, copying the dict for each in place of the
+    flattening the scanner did for each before ExprTuple."""
+    def __init__(self, exprs):
+        self.exprs = exprs
+    def evaluate(self, cdict):
+        return tuple([expr.evaluate(dict(cdict)) for expr in self.exprs])
+
+def measure(expr, data, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for cdict in data:
+            expr.evaluate(cdict)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(count=20000, repeat=3):
+    data = records(count)
+    for name, cls, source in templates():
+        restricted = cls(source, trusted=False)
+        trusted = cls(source, trusted=True)
+        for cdict in data[:100]:
+            assert restricted.evaluate(cdict) == trusted.evaluate(cdict)
+        slow = measure(restricted, data, repeat)
+        fast = measure(trusted, data, repeat)
+        print "%-9s restricted %6.2fus  trusted %6.2fus  %5.1fx" % (name,
+            slow * 1e6 / count, fast * 1e6 / count, slow / fast)
+    sources = [Config['groupby'], Config['sortby'], Config['trackid']]
+    for trusted in (False, True):
+        separate = Separate([Expr(source, trusted=trusted) for source in sources])
+        fused = ExprTuple(sources, trusted=trusted)
+        slow = measure(separate, data, repeat)
+        fast = measure(fused, data, repeat)
+        print "keys      %-10s separate %6.2fus  fused %6.2fus  %5.1fx" % (
+            'trusted' if trusted else 'restricted', slow * 1e6 / count,
+            fast * 1e6 / count, slow / fast)
+    print "expression cache: %(items)d/%(size)d items, %(hits)d hits, " \
+        "%(misses)d misses, %(evictions)d evictions" % Expr._cache.stats()
+    print "filename directory cache: %(items)d/%(size)d items, %(hits)d hits, " \
+        "%(misses)d misses, %(evictions)d evictions" % \
+        FileFormat(Config['filename'], trusted=True)._dirs.stats()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        print __doc__
+        sys.exit(1)
+    main(*[int(arg) for arg in sys.argv[1:3]])
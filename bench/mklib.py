@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Generate a synthetic library for benchmarking: tiny but valid FLAC, MP3,
+Ogg Vorbis and WavPack files with realistic tags, in a directory tree of the
+given depth, along with the covers, logs and cue sheets found beside real
+albums. The same arguments always give the same library.
+
+usage: mklib.py directory [albums [tracks [depth]]]"""
+import os
+import os.path
+import sys
+import struct
+import random
+import uuid
+from mutagen import File
+from mutagen.ogg import OggPage
+from audiomangler.tag import NormMetaData
+import audiomangler.mutagenext
+
+SECONDS = 3
+
+def write_flac(path):
+    rate, channels, bits, samples = 44100, 2, 16, 44100 * SECONDS
+    info = struct.pack('>HH', 4096, 4096) + '\0' * 6
+    info += struct.pack('>Q', rate << 44 | channels - 1 << 41 | bits - 1 << 36 | samples)
+    info += '\0' * 16
+    open(path, 'wb').write('fLaC\x80' + struct.pack('>I', len(info))[1:] + info)
+
+def write_mp3(path):
+    #MPEG-1 layer III, 128kbps, 44.1kHz, no padding
+    frame = '\xff\xfb\x90\x64' + '\0' * 413
+    open(path, 'wb').write(frame * int(SECONDS * 44100 / 1152))
+
+def write_ogg(path):
+    ident = '\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = '\x03vorbis' + struct.pack('<I', 9) + 'mklib 1.0' + struct.pack('<I', 0) + '\x01'
+    setup = '\x05vorbis' + '\0' * 32
+    pages = []
+    for sequence, packets, position in ((0, [ident], 0), (1, [comment, setup], 0),
+            (2, ['\0' * 100], 44100 * SECONDS)):
+        page = OggPage()
+        page.packets = packets
+        page.serial = 1
+        page.sequence = sequence
+        page.position = position
+        pages.append(page)
+    pages[0].first = True
+    pages[-1].last = True
+    open(path, 'wb').write(''.join(page.write() for page in pages))
+
+def write_wavpack(path):
+    samples = 44100 * SECONDS
+    #44.1kHz sample rate index, 16 bits per sample
+    flags = 9 << 23 | 1
+    block = '\0' * 64
+    open(path, 'wb').write('wvpk' + struct.pack('<IHBBIIIII', 24 + len(block), 0x410,
+        0, 0, samples, 0, samples, flags, 0) + block)
+
+writers = {
+    'flac': write_flac,
+    'mp3': write_mp3,
+    'ogg': write_ogg,
+    'wv': write_wavpack,
+}
+
+words = ('black', 'blue', 'city', 'dance', 'dream', 'echo', 'fire', 'ghost',
+    'glass', 'gold', 'heart', 'house', 'light', 'love', 'machine', 'moon',
+    'night', 'ocean', 'river', 'road', 'shadow', 'silver', 'sky', 'song',
+    'star', 'storm', 'summer', 'sun', 'time', 'water', 'wild', 'winter')
+genres = ('Rock', 'Electronic', 'Jazz', 'Classical', 'Hip-Hop', 'Folk', 'Pop')
+
+def phrase(rnd, count):
+    return u' '.join(rnd.choice(words) for i in range(count)).title()
+
+def album_meta(rnd):
+    artist = phrase(rnd, rnd.randint(1, 3))
+    meta = {
+        'albumartist': artist,
+        'album': phrase(rnd, rnd.randint(1, 4)),
+        'date': unicode(rnd.randint(1960, 2008)),
+        'genre': rnd.choice(genres),
+        'label': phrase(rnd, 2) + u' Records',
+        'catalognumber': u'%s-%04d' % (rnd.choice(words).upper()[:3], rnd.randint(1, 9999)),
+    }
+    if rnd.random() < 0.7:
+        meta['musicbrainz_albumid'] = unicode(uuid.UUID(int=rnd.getrandbits(128)))
+        meta['musicbrainz_albumartistid'] = unicode(uuid.UUID(int=rnd.getrandbits(128)))
+    return meta
+
+def track_meta(rnd, album, number, total):
+    meta = dict(album)
+    meta.update({
+        'artist': album['albumartist'] if rnd.random() < 0.9 else phrase(rnd, 2),
+        'title': phrase(rnd, rnd.randint(1, 5)),
+        'tracknumber': number,
+        'totaltracks': total,
+    })
+    if 'musicbrainz_albumid' in album:
+        meta['musicbrainz_trackid'] = unicode(uuid.UUID(int=rnd.getrandbits(128)))
+    if rnd.random() < 0.5:
+        meta['replaygain_track_gain'] = u'%.2f dB' % rnd.uniform(-12, 3)
+        meta['replaygain_track_peak'] = u'%.6f' % rnd.uniform(0.5, 1)
+    return meta
+
+def write_track(path, meta):
+    writers[os.path.splitext(path)[1][1:]](path)
+    f = File(path)
+    f.meta = NormMetaData(meta)
+    f.save()
+
+def write_extras(rnd, path):
+    "Write some of the non-audio files found beside real albums."
+    if rnd.random() < 0.8:
+        open(os.path.join(path, 'cover.jpg'), 'wb').write('\xff\xd8\xff\xe0' +
+            os.urandom(rnd.randint(1000, 20000)))
+    if rnd.random() < 0.3:
+        open(os.path.join(path, 'rip.log'), 'w').write('Exact Audio Copy\n' * 50)
+    if rnd.random() < 0.3:
+        open(os.path.join(path, 'album.cue'), 'w').write('FILE "album.flac" WAVE\n')
+    if rnd.random() < 0.1:
+        open(os.path.join(path, 'info.nfo'), 'w').write('release notes\n')
+
+def generate(root, albums=100, tracks=10, depth=2, seed=0):
+    """Generate a library of albums below root, with up to tracks tracks each,
+    nested under depth levels of directories (the last being the artist),
+    returning the number of tracks written."""
+    rnd = random.Random(seed)
+    written = 0
+    for i in range(albums):
+        album = album_meta(rnd)
+        parts = [u'Collection %d' % rnd.randint(1, 4) for level in range(depth - 1)]
+        parts.append(album['albumartist'])
+        parts.append(u'%s (%s)' % (album['album'], album['date']))
+        path = os.path.join(root, *[part.encode('utf-8') for part in parts])
+        if os.path.exists(path):
+            path += ' [%d]' % i
+        os.makedirs(path)
+        ext = rnd.choice(sorted(writers))
+        total = rnd.randint(max(1, tracks / 2), tracks)
+        for number in range(1, total + 1):
+            meta = track_meta(rnd, album, number, total)
+            name = u'%02d %s.%s' % (number, meta['title'], ext)
+            write_track(os.path.join(path, name.encode('utf-8')), meta)
+            written += 1
+        write_extras(rnd, path)
+    return written
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    print generate(sys.argv[1], *[int(arg) for arg in sys.argv[2:5]]), 'tracks written'
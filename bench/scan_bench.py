@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Time scanner.scan over a synthetic library (see mklib.py): a cold scan
+with an empty index and dropped caches, a warm scan with nothing changed,
+and a rescan after retagging and touching some files, removing some albums
+and adding others. Each scan runs in its own process, which reports the
+time spent walking and parsing (in scan_dirs) apart from the time spent on
+keys and grouping, along with its peak RSS and that of its worker
+processes. The library and index are removed afterwards.
+
+usage: scan_bench.py [albums [tracks [depth]]]
+
+Dropping caches needs root; without it the cold scan is only cold as far
+as the index is concerned."""
+import os
+import os.path
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import resource
+import mklib
+from audiomangler import scanner, scanindex
+
+def drop_caches():
+    os.system('sync')
+    try:
+        f = open('/proc/sys/vm/drop_caches', 'w')
+    except IOError:
+        return False
+    f.write('3\n')
+    f.close()
+    return True
+
+def timed_scan_dirs(scan_dirs, timings):
+    "Wrap scan_dirs to add the time spent inside it to timings['walk']."
+    def wrapper(*args, **kwargs):
+        gen = scan_dirs(*args, **kwargs)
+        while True:
+            start = time.time()
+            try:
+                item = gen.next()
+            finally:
+                timings['walk'] += time.time() - start
+            yield item
+    return wrapper
+
+def run_scan(root):
+    timings = {'walk': 0.0}
+    scanner.scan_dirs = timed_scan_dirs(scanner.scan_dirs, timings)
+    start = time.time()
+    albums, dirs, trackids, collisions = scanner.scan([root])
+    timings['total'] = time.time() - start
+    timings['keys'] = timings['total'] - timings['walk']
+    timings['tracks'] = len(trackids)
+    timings['albums'] = len(albums)
+    #ru_maxrss is in kilobytes on Linux
+    timings['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    timings['workers_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+    return timings
+
+def measure(root):
+    "Run a scan of root in a child process, returning its report."
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(rfd)
+        status = 1
+        try:
+            os.write(wfd, json.dumps(run_scan(root)))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(wfd)
+    data = []
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(rfd)
+    pid, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("scan failed with status %d" % status)
+    return json.loads(''.join(data))
+
+def modify(root, fraction=0.05, seed=1):
+    """Change about fraction of the library below root: retag some tracks,
+    touch others, remove some albums and add new ones."""
+    rnd = random.Random(seed)
+    albums = sorted(path for path, dirs, files in os.walk(root)
+        if any(os.path.splitext(name)[1][1:] in mklib.writers for name in files))
+    later = time.time() + 2
+    for path in albums:
+        for name in sorted(os.listdir(path)):
+            if os.path.splitext(name)[1][1:] not in mklib.writers:
+                continue
+            track = os.path.join(path, name)
+            chance = rnd.random()
+            if chance < fraction:
+                f = mklib.File(track)
+                meta = f.meta.copy()
+                meta['title'] = mklib.phrase(rnd, 3)
+                f.meta = meta
+                f.save()
+            if chance < fraction or chance > 1 - fraction:
+                os.utime(track, (later, later))
+    count = max(1, int(len(albums) * fraction))
+    for path in rnd.sample(albums, count):
+        shutil.rmtree(path)
+    return mklib.generate(os.path.join(root, 'Added'), count, seed=seed)
+
+def report(name, result, cold=True):
+    print "%-9s %5d tracks %4d albums  %7.2fs total %7.2fs walk %7.2fs keys" \
+        "  %6.1fM rss %6.1fM workers%s" % (name, result['tracks'], result['albums'],
+        result['total'], result['walk'], result['keys'], result['rss'],
+        result['workers_rss'], '' if cold else ' (warm)')
+
+def main(albums=200, tracks=10, depth=3):
+    work = tempfile.mkdtemp()
+    root = os.path.join(work, 'library')
+    index = os.path.join(work, 'index.db')
+    scanindex.default_path = lambda: index
+    try:
+        start = time.time()
+        written = mklib.generate(root, albums, tracks, depth)
+        print "generated %d tracks in %.2fs" % (written, time.time() - start)
+        cold = drop_caches()
+        report('cold', measure(root), cold)
+        report('warm', measure(root))
+        added = modify(root)
+        print "modified library, %d tracks added" % added
+        report('modified', measure(root))
+    finally:
+        shutil.rmtree(work)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        print __doc__
+        sys.exit(1)
+    main(*[int(arg) for arg in sys.argv[1:4]])
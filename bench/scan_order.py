@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Time reading the headers of every file below a directory, cold, with each
+scan_order setting, with and without readahead hints.
+
+usage: scan_order.py directory [readahead bytes]
+
+Caches are dropped before each run, which needs root. Without root the runs
+are warm and only show the overhead of ordering."""
+import os
+import os.path
+import sys
+import time
+from audiomangler import scanner
+from audiomangler.config import Config
+
+def drop_caches():
+    os.system('sync')
+    try:
+        f = open('/proc/sys/vm/drop_caches', 'w')
+    except IOError:
+        return False
+    f.write('3\n')
+    f.close()
+    return True
+
+def batches(root):
+    result = []
+    dirs = [root]
+    while dirs:
+        path = dirs.pop(0)
+        files = []
+        for filename, isdir, fst in scanner.list_dir(path):
+            if isdir:
+                dirs.append(filename)
+            else:
+                files.append(filename)
+        if files:
+            result.append(files)
+    return result
+
+def grouped(root, order):
+    "Join directories into batches of up to scan_batch files, as scan_dirs does."
+    size = int(Config['scan_batch'] or 0) if order in ('inode', 'extent') else 0
+    result = []
+    for files in batches(root):
+        if result and len(result[-1]) < size:
+            result[-1].extend(files)
+        else:
+            result.append(files)
+    return result
+
+def measure(root, order, ahead):
+    groups = grouped(root, order)
+    cold = drop_caches()
+    start = time.time()
+    tracks = 0
+    for paths in groups:
+        tracks += len([t for t in scanner.scan_batch(paths, None, order, ahead) if t is not None])
+    return tracks, time.time() - start, cold
+
+def main(root, ahead):
+    for order in ('name', 'inode', 'extent'):
+        for readahead in (0, ahead):
+            tracks, elapsed, cold = measure(root, order, readahead)
+            print "%-6s  readahead %-7d %d tracks, %.2fs%s" % (order, readahead,
+                tracks, elapsed, '' if cold else ' (warm)')
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print __doc__
+        sys.exit(1)
+    main(os.path.abspath(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 65536)
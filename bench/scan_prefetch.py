@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Time a cold scan of a directory with and without the header prefetch
+threads, using a throwaway scan index.
+
+usage: scan_prefetch.py directory [threads...]
+
+The directory should be on the kind of filesystem being tuned for. For a
+local stand-in with injected latency, build a filesystem on a dm-delay
+device, for example:
+
+    dd if=/dev/zero of=/tmp/slow.img bs=1M count=512
+    losetup /dev/loop0 /tmp/slow.img
+    dmsetup create slow --table "0 $(blockdev --getsz /dev/loop0) delay /dev/loop0 0 20"
+    mkfs.ext4 /dev/mapper/slow && mount /dev/mapper/slow /mnt/slow
+
+and copy a library into it. Caches are dropped before each run, which needs
+root; without it the runs are warm."""
+import os
+import os.path
+import sys
+import time
+import tempfile
+from audiomangler.config import Config
+from audiomangler import scanner, scanindex
+
+def drop_caches():
+    os.system('sync')
+    try:
+        f = open('/proc/sys/vm/drop_caches', 'w')
+    except IOError:
+        return False
+    f.write('3\n')
+    f.close()
+    return True
+
+def measure(root, threads):
+    index = tempfile.mktemp(suffix='.db')
+    scanindex.default_path = lambda: index
+    Config['scan_prefetch_threads'] = str(threads)
+    cold = drop_caches()
+    start = time.time()
+    try:
+        tracks = sum(len(found) for path, found in scanner.scan_dirs([root]))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(index + suffix):
+                os.unlink(index + suffix)
+    return tracks, time.time() - start, cold
+
+def main(root, counts):
+    for threads in counts:
+        tracks, elapsed, cold = measure(root, threads)
+        print "%2d threads  %d tracks, %.2fs%s" % (threads, tracks, elapsed,
+            '' if cold else ' (warm)')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(os.path.abspath(sys.argv[1]), [int(n) for n in sys.argv[2:]] or [0, 4, 16])
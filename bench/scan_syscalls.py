@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+"""Count the filesystem calls made per file while listing a directory tree,
+comparing the old listdir/isdir/isfile/stat loop with scanner.list_dir.
+
+usage: scan_syscalls.py directory
+
+Calls are counted at the Python level. DirEntry.is_dir() and is_file() are
+not counted; they cost nothing when the filesystem reports d_type."""
+import os
+import os.path
+import sys
+from audiomangler import scanner
+
+counts = {}
+
+def counted(name, func):
+    def proxy(*args, **kwargs):
+        counts[name] = counts.get(name, 0) + 1
+        return func(*args, **kwargs)
+    return proxy
+
+class CountedEntry(object):
+    def __init__(self, entry):
+        self._entry = entry
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def stat(self):
+        counts['DirEntry.stat'] = counts.get('DirEntry.stat', 0) + 1
+        return self._entry.stat()
+
+def legacy_list_dir(path):
+    result = []
+    for filename in (os.path.join(path, f) for f in sorted(os.listdir(path))):
+        if os.path.isdir(filename):
+            result.append((filename, True, None))
+        elif os.path.isfile(filename):
+            try:
+                fst = os.stat(filename)
+            except Exception:
+                continue
+            result.append((filename, False, fst))
+    return result
+
+def walk(root, list_dir):
+    files = 0
+    dirs = [root]
+    while dirs:
+        path = dirs.pop(0)
+        for filename, isdir, fst in list_dir(path):
+            if isdir:
+                dirs.append(filename)
+            else:
+                files += 1
+    return files
+
+def measure(root, list_dir):
+    counts.clear()
+    files = walk(root, list_dir)
+    return files, dict(counts)
+
+def main(root):
+    os.stat = counted('stat', os.stat)
+    os.lstat = counted('lstat', os.lstat)
+    os.listdir = counted('listdir', os.listdir)
+    if scanner.scandir is not None:
+        scandir = scanner.scandir
+        scanner.scandir = counted('scandir', lambda path: [CountedEntry(e) for e in scandir(path)])
+    for label, list_dir in (('before', legacy_list_dir), ('after', scanner.list_dir)):
+        files, calls = measure(root, list_dir)
+        total = sum(calls.values())
+        print "%-6s  %d files, %d calls, %.2f calls/file" % (label, files, total, float(total) / max(files, 1))
+        for name in sorted(calls):
+            print "        %-14s %d" % (name, calls[name])
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print __doc__
+        sys.exit(1)
+    main(os.path.abspath(sys.argv[1]))
@@ -18,6 +18,7 @@ setup(
             'am_sync = audiomangler.cli:sync',
             'am_transcode = audiomangler.cli:sync',
             'am_replaygain = audiomangler.cli:replaygain',
+            'am_watch = audiomangler.cli:watch',
         ]
     },
 )
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+###########################################################################
+#    Copyright (C) 2008 by Andrew Mahone
+#    <andrew.mahone@gmail.com>
+#
+# Copyright: See COPYING file that comes with this distribution
+#
+###########################################################################
+import os
+import os.path
+import sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import mklib
+from audiomangler.config import Config
+from audiomangler.scanner import scan, target_trackids
+
+class TargetTrackidsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.getenv('HOME')
+        os.environ['HOME'] = self.tmp
+        self.root = os.path.join(self.tmp, 'library')
+        mklib.generate(self.root, albums=6, tracks=4, depth=2)
+        self.base = Config['base']
+        Config['base'] = self.root
+
+    def tearDown(self):
+        Config['base'] = self.base
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+        shutil.rmtree(self.tmp)
+
+    def test_matches_scan(self):
+        #a sync target usually hasn't been scanned before; the second call
+        #gets the trackids stored by the first from the index.
+        first = target_trackids(jobs=1)
+        second = target_trackids(jobs=1)
+        expected = set(scan([self.root], jobs=1)[2])
+        self.assertTrue(expected)
+        self.assertEqual(first, expected)
+        self.assertEqual(second, expected)
+
+if __name__ == '__main__':
+    unittest.main()